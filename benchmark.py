@@ -0,0 +1,218 @@
+import os
+import json
+import time
+import argparse
+import platform
+import subprocess
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
+from parsers.synthetic_utils import generate_dataset
+from parsers.goa_utils import filter_evidence, load_annotations, clean_annotations, propagate_terms, \
+    get_all_taxonomies
+from parsers.obo_utils import load_ontology
+from parsers.fasta_index import build_fasta_index, export_sqlite
+from parsers.fasta_utils import read_fasta_sql
+from parsers.run_report import reset_peak_memory, memory_usage
+from make_dataset import find_sequences
+
+
+# functions timed at each scale, in pipeline order
+BENCHMARKS = ['filter_evidence', 'clean_annotations', 'propagate_terms', 'get_all_taxonomies',
+              'read_fasta_sql', 'read_fasta_index', 'find_sequences']
+
+
+def prepare_inputs(dataset):
+    """ Intermediate files the benchmarks start from, built once per dataset (and not timed): the filtered and
+        cleaned annotations, the compiled ontology and the native and SQLite indexes of the TrEMBL file """
+    location = os.path.dirname(dataset['gaf'])
+    filtered_file = os.path.join(location, 'evidence.parquet')
+    annotations_file = os.path.join(location, 'annotations.parquet')
+    if not os.path.exists(annotations_file):
+        filter_evidence(dataset['gaf'], filtered_file, highthr=True, load=False)
+        clean_annotations(load_annotations(filtered_file)).to_parquet(annotations_file)
+    load_ontology(dataset['obo'])
+    index = build_fasta_index(dataset['trembl'])
+    sqlite_index = dataset['trembl'] + '.idx'
+    if not os.path.exists(sqlite_index):
+        export_sqlite(index, dataset['trembl'], sqlite_index)
+    return filtered_file, annotations_file
+
+
+def setup_benchmark(name, dataset, workers=1):
+    """
+    Load the inputs of a benchmark.
+
+    :return: (function to time, number of input rows it processes)
+    """
+    location = os.path.dirname(dataset['gaf'])
+    filtered_file = os.path.join(location, 'evidence.parquet')
+    annotations_file = os.path.join(location, 'annotations.parquet')
+
+    if name == 'filter_evidence':
+        save_location = os.path.join(location, 'benchmark_evidence.parquet')
+        return (lambda: filter_evidence(dataset['gaf'], save_location, highthr=True, workers=workers, load=False),
+                dataset['rows'])
+    if name == 'clean_annotations':
+        filtered = load_annotations(filtered_file)
+        return lambda: clean_annotations(filtered), len(filtered)
+    if name == 'propagate_terms':
+        annotations_df = pd.read_parquet(annotations_file, columns=['DB_Object_ID', 'GO_ID', 'Aspect'])
+        return lambda: propagate_terms(annotations_df, dataset['obo']), len(annotations_df)
+    if name == 'get_all_taxonomies':
+        annotations_df = pd.read_parquet(annotations_file, columns=['DB_Object_ID', 'species'])
+        return lambda: get_all_taxonomies(annotations_df), len(annotations_df)
+
+    proteins = set(pd.read_parquet(annotations_file, columns=['DB_Object_ID']).DB_Object_ID.unique())
+    # all proteins are looked up in TrEMBL, about half of them are found
+    if name == 'read_fasta_sql':
+        # SQLite index, as created by Bio.SeqIO.index_db
+        return lambda: read_fasta_sql(dataset['trembl'] + '.idx', dataset['trembl'], proteins), len(proteins)
+    if name == 'read_fasta_index':
+        # native index, see fasta_index.build_fasta_index
+        return lambda: read_fasta_sql(dataset['trembl'] + '.fidx', dataset['trembl'], proteins), len(proteins)
+    if name == 'find_sequences':
+        return (lambda: list(find_sequences(proteins, dataset['swissprot'], dataset['trembl'],
+                                            dataset['trembl'] + '.idx')),
+                len(proteins))
+    raise ValueError(f'Unknown benchmark {name}')
+
+
+def run_benchmark(name, dataset, repeat=1, workers=1):
+    """
+    Time a benchmark and measure its peak memory. Runs in its own process, so the memory left over by other
+    benchmarks is not counted.
+
+    :return: dict with the rows processed, best wall and CPU time in seconds, throughput in rows per second
+             and peak resident memory in MB during the call, and resident memory before the call
+    """
+    run, rows = setup_benchmark(name, dataset, workers=workers)
+    timings = []
+    for _ in range(repeat):
+        baseline = memory_usage()
+        exact_peak = reset_peak_memory()
+        start_time, start_cpu = time.perf_counter(), time.process_time()
+        run()
+        timings.append((time.perf_counter() - start_time, time.process_time() - start_cpu))
+    seconds, cpu_seconds = min(timings)
+    return {'rows': int(rows), 'seconds': seconds, 'cpu_seconds': cpu_seconds,
+            'rows_per_second': rows / seconds if seconds > 0 else None,
+            'peak_memory_mb': memory_usage(peak=True) / 1024**2, 'baseline_memory_mb': baseline / 1024**2,
+            'exact_peak': exact_peak}
+
+
+def load_dataset(location, n_rows, n_terms, gzipped, seed):
+    """ Synthetic inputs with n_rows GAF lines in location, generated again only if the parameters changed """
+    params = {'rows': n_rows, 'terms': n_terms, 'gzipped': gzipped, 'seed': seed}
+    params_file = os.path.join(location, 'dataset.json')
+    if os.path.exists(params_file):
+        with open(params_file) as f:
+            dataset = json.load(f)
+        if {name: dataset.get(name) for name in params} == params:
+            return dataset
+
+    print(f'Generating synthetic inputs with {n_rows} annotations in {location}')
+    start_time = time.time()
+    dataset = {**generate_dataset(location, n_rows, n_terms=n_terms, gzipped=gzipped, seed=seed), **params}
+    print(f'Time elapsed: {time.time() - start_time:.1f} s')
+    with ProcessPoolExecutor(1) as executor:
+        executor.submit(prepare_inputs, dataset).result()
+    with open(params_file, 'w') as f:
+        json.dump(dataset, f, indent=1)
+    return dataset
+
+
+def git_commit():
+    """ Commit of the code being benchmarked, if run from a git checkout """
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def compare_results(baseline, results, tolerance=0.1, min_seconds=0.05):
+    """
+    Compare two benchmark runs. A benchmark is a regression if its time or peak memory is more than
+    tolerance (relative) above the baseline at the same scale. Time differences under min_seconds are noise.
+
+    :param baseline: results saved by an earlier run of this script
+    :param results: results of this run
+    :return: DataFrame with one row per benchmark and scale found in both runs
+    """
+    columns = ['benchmark', 'scale', 'seconds', 'peak_memory_mb']
+    merged = pd.DataFrame(baseline['results'])[columns].merge(pd.DataFrame(results['results'])[columns],
+                                                              on=['benchmark', 'scale'], suffixes=('_baseline', ''))
+    merged['time_ratio'] = merged.seconds / merged.seconds_baseline
+    merged['memory_ratio'] = merged.peak_memory_mb / merged.peak_memory_mb_baseline
+    slower = (merged.time_ratio > 1 + tolerance) & (merged.seconds - merged.seconds_baseline > min_seconds)
+    merged['regression'] = slower | (merged.memory_ratio > 1 + tolerance)
+    return merged
+
+
+if __name__ == '__main__':
+    """
+    Benchmark the steps of the pipeline on synthetic inputs of several sizes (see parsers/synthetic_utils.py)
+    and save their time, throughput and peak memory to a JSON file, to compare with later runs
+    """
+
+    parser = argparse.ArgumentParser(description='Benchmark the annotation and sequence processing steps on synthetic data')
+    parser.add_argument('--scales', nargs='+', type=int, default=[10000, 100000, 1000000],
+                        help='Numbers of GAF lines to benchmark with (default: 10000 100000 1000000). '
+                             'Inputs of 100000000 lines take about 25 GB of disk')
+    parser.add_argument('--benchmarks', nargs='+', choices=BENCHMARKS, default=BENCHMARKS,
+                        help='Functions to benchmark (default: all)')
+    parser.add_argument('--data-dir', default='benchmark_data',
+                        help='Directory of the synthetic inputs, reused by later runs with the same parameters (default: benchmark_data)')
+    parser.add_argument('--output', '-o', default='benchmark_results.json',
+                        help='JSON file to save the results to (default: benchmark_results.json)')
+    parser.add_argument('--baseline', default=None,
+                        help='Results of an earlier run to compare with. Regressions are listed at the end')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='Relative increase in time or memory over the baseline reported as a regression (default: 0.1)')
+    parser.add_argument('--terms', type=int, default=45000,
+                        help='Approximate number of terms of the synthetic ontology (default: 45000, about the size of GO)')
+    parser.add_argument('--gzip', action='store_true',
+                        help='Flag to benchmark a gzipped GAF file')
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='Number of times each benchmark is run, the fastest run is kept (default: 1)')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of processes used by filter_evidence (default: 1). Memory of the workers is not measured')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Random seed of the synthetic inputs')
+    args = parser.parse_args()
+
+    results = {'date': datetime.now().isoformat(timespec='seconds'), 'commit': git_commit(),
+               'python': platform.python_version(), 'platform': platform.platform(), 'cpus': os.cpu_count(),
+               'pandas': pd.__version__, 'terms': args.terms, 'gzip': args.gzip, 'workers': args.workers,
+               'seed': args.seed, 'results': []}
+
+    for scale in sorted(args.scales):
+        dataset = load_dataset(os.path.join(args.data_dir, f'rows_{scale}'), scale, args.terms, args.gzip, args.seed)
+        for name in args.benchmarks:
+            # a new process for each benchmark, see run_benchmark
+            with ProcessPoolExecutor(1) as executor:
+                result = executor.submit(run_benchmark, name, dataset, repeat=args.repeat, workers=args.workers).result()
+            print(f'{name} on {scale} lines: {result["seconds"]:.2f} s, {result["rows"]} rows, '
+                  f'{result["rows_per_second"] or 0:.0f} rows/s, peak memory {result["peak_memory_mb"]:.0f} MB')
+            results['results'].append({'benchmark': name, 'scale': scale, **result})
+            # save after each benchmark, so a run that fails or runs out of memory keeps its results
+            with open(args.output, 'w') as f:
+                json.dump(results, f, indent=1)
+    print(f'Saved results to {args.output}')
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        comparison = compare_results(baseline, results, tolerance=args.tolerance)
+        print(f'Compared with {args.baseline} (commit {baseline.get("commit")}):')
+        print(comparison[['benchmark', 'scale', 'seconds_baseline', 'seconds', 'time_ratio',
+                          'peak_memory_mb_baseline', 'peak_memory_mb', 'memory_ratio']].to_string(index=False))
+        regressions = comparison[comparison.regression]
+        if len(regressions):
+            print(f'{len(regressions)} regressions of more than {args.tolerance:.0%}:')
+            for row in regressions.itertuples():
+                print(f'  {row.benchmark} on {row.scale} lines: {row.time_ratio:.2f}x time, '
+                      f'{row.memory_ratio:.2f}x memory')
+        else:
+            print('No regressions')
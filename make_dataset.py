@@ -3,94 +3,91 @@ import sys
 import json   
 import time
 from tqdm import tqdm
-import urllib.request
-import gzip
-import shutil
 import argparse
+from concurrent.futures import ProcessPoolExecutor
 
 import pandas as pd
 import networkx as nx
 import obonet
 from Bio import SeqIO
-from parsers.fasta_utils import read_fasta_sql
-from parsers.goa_utils import filter_evidence, clean_annotations, propagate_terms
+from parsers.fasta_utils import iter_fasta_sql, iter_fasta_subset, write_fasta_subset
+from parsers.fasta_index import build_fasta_index, is_fasta_index
+from parsers.goa_utils import export_json
+from parsers.label_utils import load_propagated
+from parsers.stage_cache import download_file, run_stage, publish, remove_outputs, input_fingerprint
+from parsers.pipeline_utils import filter_stage, clean_stage, label_stages
+from parsers.run_report import start_report, finish_report, report_stage, report_rows, count_cache, \
+    collect_stages, add_stages
+from parsers.sequence_store import build_sequence_store
 
 
 def file_length(filename):
     return sum(1 for line in open(filename, 'rb'))
 
 
-def download_gofile(source_path, save_path):
-    if not os.path.exists(save_path):
-        urllib.request.urlretrieve(source_path, filename=os.path.join(save_path))
-    
-    out_file = save_path.split('.gz')[0]
-    if not os.path.exists(out_file):
-        with gzip.open(save_path, 'rb') as f_in:
-            with open(out_file, 'wb') as f_out:
-                shutil.copyfileobj(f_in, f_out)
-    return out_file
-
-
-def get_all_taxonomies(annotations_df):
-
-    # get species for each protein
-    taxonomy_df = annotations_df[['DB_Object_ID', 'species']].drop_duplicates()
-    taxonomy_df = taxonomy_df.rename({'DB_Object_ID':'EntryID', 'species':'taxonomyID'}, axis=1)
-    # make sure there aren't repeated protein entries and all proteins are in list
-    assert len(taxonomy_df)==len(taxonomy_df.EntryID.unique()), 'Some taxonomy ID is duplicated'
-  
-    return taxonomy_df
-
-
-def find_sequences(terms_df, swissprot, trembl, trembl_index):
-    # load sequences
-    record_dict = SeqIO.to_dict(SeqIO.parse(swissprot, "fasta"))
-
+def find_sequences(proteins, swissprot, trembl, trembl_index, workers=1):
+    """
+    Find the sequences of a set of proteins. The Swiss-Prot file is read once as a stream and only
+    the matching records are kept. Proteins that are not in Swiss-Prot are looked up in the TrEMBL index.
+
+    :param proteins: set of UniProt accessions
+    :param swissprot: Swiss-Prot fasta file
+    :param trembl: TrEMBL fasta file, or None to only use Swiss-Prot
+    :param trembl_index: SQLite index of the TrEMBL file, used if there is no <trembl>.fidx index
+    :param workers: number of processes used to index the TrEMBL file if it has no index yet
+    :return: generator of biopython SeqRecord objects with ID set to the UniProt accession
+    """
     # SwissProt FASTA file uses keys with format "sp|uniprot_acession_id|gene_name". 
-    # We want to use on the accession id, so we map the orignal keys to this id
-
-    # first make sure each UniProt accession ID maps to one key in the record dictionary
-    assert len(record_dict)==len(set(orig_key.split('|')[1] for orig_key in record_dict.keys()))
-
-    accession_id_map = {orig_key.split('|')[1]:orig_key for orig_key in record_dict.keys()}
-
-    # find all proteins that are in the SwissProt DB
-    proteins_with_terms = set(terms_df.EntryID.unique().tolist())
-    proteins_in_sp = set(accession_id_map.keys()).intersection(proteins_with_terms)
-
-    # Get sequences for all proteins in dataset
-    # Set ID in FASTA records to UniProt accession ID
-    # First get sequences that are in SwissProt
-    for accession in proteins_in_sp:
-        record_dict[accession_id_map[accession]].id = accession
-
-    records = [record_dict[accession_id_map[protein]] for protein in proteins_in_sp] 
-
-    if len(proteins_with_terms.difference(proteins_in_sp)) > 0:
+    # Records are matched and returned with the accession id
+    proteins_in_sp = set()
+    for record in iter_fasta_subset(swissprot, proteins):
+        if record.id not in proteins_in_sp:
+            proteins_in_sp.add(record.id)
+            yield record
+
+    missing_proteins = set(proteins).difference(proteins_in_sp)
+    if len(missing_proteins) > 0 and trembl is None:
+        print(f'{len(missing_proteins)} proteins not found in Swiss-Prot. No TrEMBL file given')
+    elif len(missing_proteins) > 0:
         print('Processing trEMBL sequence file.')
-        if os.path.exists(trembl_index):
-            tr_records = read_fasta_sql(trembl_index, trembl, set(proteins_with_terms).difference(proteins_in_sp))
+        native_index = trembl + '.fidx'
+        count_cache('fasta_index', is_fasta_index(native_index) or os.path.exists(trembl_index))
+        if is_fasta_index(native_index):
+            yield from iter_fasta_sql(native_index, trembl, missing_proteins)
+        elif os.path.exists(trembl_index):
+            yield from iter_fasta_sql(trembl_index, trembl, missing_proteins)
         else:
-            print('Processing may take about 30 minues if TrEMBL file has not been previously indexed') 
+            print(f'TrEMBL file has not been previously indexed. Creating index {native_index}')
             start_time = time.time()
-            def get_accession(name):
-                parts = name.split("|")
-                return parts[1]
-            indices_sql = SeqIO.index_db(trembl_index, trembl, "fasta",
-                                         key_function=get_accession)
-            tr_records = []
-            for accession in set(proteins_with_terms).difference(proteins_in_sp):
-                seqrecord = indices_sql[accession]
-                seqrecord.id = accession  # change the ID to just the accession number
-                tr_records.append(seqrecord)
-
+            build_fasta_index(trembl, native_index, workers=workers)
             print(f'Time elapsed: {(time.time()-start_time)/60}')
+            yield from iter_fasta_sql(native_index, trembl, missing_proteins)
 
-        records += tr_records
 
-    return records
-  
+def sequence_stage(cache_dir, annotations_file, clean_key, sequence_files, swissprot, trembl, trembl_index, workers=1):
+    """
+    Find the sequences of all proteins of the cleaned annotations as a cached stage. Runs in a background process.
+
+    :return: (((directory with sequences.fasta, seconds spent), key of the stage), stages recorded for the
+             run report, see run_report.add_stages)
+    """
+    start_time = time.time()
+
+    def save_sequences(location):
+        proteins = set(pd.read_parquet(annotations_file, columns=['DB_Object_ID']).DB_Object_ID.unique())
+        records = find_sequences(proteins, swissprot=swissprot, trembl=trembl, trembl_index=trembl_index,
+                                 workers=workers)
+        # records are written as they are found, through a single handle
+        with open(os.path.join(location, 'sequences.fasta'), 'w') as handle:
+            n_records = SeqIO.write(records, handle, 'fasta')
+        report_rows(rows_in=len(proteins), rows_out=n_records)
+
+    # the report of this process is not saved, its stages are sent back to the main process
+    with collect_stages() as stages:
+        result = run_stage(cache_dir, 'sequences', build=save_sequences,
+                           load=lambda location: (location, time.time() - start_time),
+                           files=sequence_files, depends=[clean_key])
+    return result, stages
 
 
 if __name__ == '__main__':
@@ -106,30 +103,54 @@ if __name__ == '__main__':
     parser.add_argument('--dest', '-d', 
                         help='Path to save processed files. Will be created if does not exist.')    
     parser.add_argument('--gaf', '-g', default=None, 
-                        help='Path to GAF file with annotations. If none provided, will download from ebi.ac.uk')
+                        help='Path to GAF file with annotations, can be gzipped. If none provided, will download from ebi.ac.uk')
     parser.add_argument('--obo', '-o', default=None, 
                         help='Path to OBO graph file if local. If empty (default) current OBO structure at run-time will be downloaded from http://purl.obolibrary.org/obo/go/go-basic.obo')
     parser.add_argument('--swiss', '-s',
                         help='Path to swissprot fasta file')
     parser.add_argument('--trembl', '-t',
-                        help='Path to trembl fasta file. Index file should have the name and in the same path but with .idx file extension')
+                        help='Path to trembl fasta file. Index file should have the name and in the same path but with .fidx (see process_fasta.py --native) or .idx file extension')
+    parser.add_argument('--taxa', nargs='+', type=int, default=None,
+                        help='NCBI taxon IDs of the species to keep, eg. 9606 10090. Other annotations are dropped while the GAF file is read')
+    parser.add_argument('--proteins-file', default=None,
+                        help='Text file with the UniProt accessions of the proteins to keep, one per line. Other annotations are dropped while the GAF file is read')
+    parser.add_argument('--workers', '-w', type=int, default=1,
+                        help='Number of processes used to filter the GAF file and index the TrEMBL file (default 1)')
+    parser.add_argument('--json', action='store_true',
+                        help='Flag to also export the filtered annotations as JSON lines (<gaf>_evidence.json)')
+    parser.add_argument('--cache-dir', default=None,
+                        help='Directory of cached intermediate results (default <dest>/cache). Each step is only recomputed when its inputs or parameters change')
+    parser.add_argument('--sequence-store', action='store_true',
+                        help='Flag to also save the sequences as arrays that can be memory-mapped in sequences.store (see parsers/sequence_store.py)')
+    parser.add_argument('--dedup', action='store_true',
+                        help='Flag to store identical sequences only once in sequences.store')
+    parser.add_argument('--report', default=None,
+                        help='JSON file to save a report of the run to: time, CPU, rows, bytes read and peak memory of each stage, and cache hits (default <dest>/run_report.json)')
+    parser.add_argument('--profile', default=None, metavar='STAGE',
+                        help='Name of a stage to profile with cProfile, eg. filter, clean, propagate or sequences. The profile is saved to profile_<stage>.prof next to the report')
 
     args = parser.parse_args()
     
     # set up save path
     if args.dest is None: 
-        save_location=path.join(os.getcwd(),'data')
+        save_location=os.path.join(os.getcwd(),'data')
     else:
         save_location=args.dest
      
     #os.makedirs(data_location, exist_ok=True) # create source dir in case we need to download any raw files
     os.makedirs(save_location, exist_ok=True)
 
+    # time, memory and cache hits of each stage are saved when the script exits
+    start_report(args.report if args.report is not None else os.path.join(save_location, 'run_report.json'),
+                 profile_stage=args.profile)
+
     # get ontology structure
     if args.obo is not None:
         obo_file = args.obo
     else:
-        obo_file = None
+        print('Downloading OBO file from http://purl.obolibrary.org/obo/go/go-basic.obo')
+        obo_file = download_file('http://purl.obolibrary.org/obo/go/go-basic.obo',
+                                   os.path.join(save_location, 'go-basic.obo'))
 
     # get raw annotations
     if args.gaf is not None:
@@ -138,58 +159,104 @@ if __name__ == '__main__':
         goa_file = 'goa_uniprot_all.gaf.gz'
         file_source = 'https://ftp.ebi.ac.uk/pub/databases/GO/goa/UNIPROT/'
 
-        # download and decompress file
+        # download file
         annot_file = os.path.join(save_location, goa_file)
         
         if not os.path.exists(annot_file):
             print(f'Downloading GO Annotation File (GAF) file {goa_file} from {file_source}')    
-            annot_file = download_gofile(os.path.join(file_source,goa_file), annot_file)
-            print(f'Decompressed file location: {annot_file}')
+            annot_file = download_file(os.path.join(file_source,goa_file), annot_file)
+            print(f'File location: {annot_file}')
+        goa_file = annot_file
  
     swissprot_file = args.swiss
     trembl_file = args.trembl
-    trembl_index_file = args.trembl+'.idx'
+    trembl_index_file = args.trembl+'.idx' if args.trembl is not None else None
+
+    # Each step is cached in cache_dir under a key of its inputs and parameters, and is only
+    # recomputed when one of them changes
+    cache_dir = args.cache_dir if args.cache_dir is not None else os.path.join(save_location, 'cache')
 
-    # output file to save
-    filtered_file=os.path.join(save_location, os.path.split(goa_file)[-1].split('.')[0]+'_evidence.json')
-    
     # save filtered evidence to file
-    if not os.path.exists(filtered_file):
-        print('Extracting annotations with experiment evidence codes')
-        print(f'Saving to {filtered_file}')
-        filtered_annotations = filter_evidence(goa_file, filtered_file) 
-    else:
-        print(f'Filtered evidence GO annotation file exists. Loading annotations from file {filtered_file}')
-        filtered_annotations = pd.read_json(filtered_file, lines=True)
+    print('Extracting annotations with experiment evidence codes')
+    filtered_file, filter_key = filter_stage(cache_dir, goa_file, highthr=True, workers=args.workers,
+                                             taxa=args.taxa, proteins_file=args.proteins_file)
+    print(f'Filtered annotations: {filtered_file}')
+    if args.json:
+        json_file = os.path.join(save_location, os.path.split(goa_file)[-1].split('.')[0]+'_evidence.json')
+        print(f'Exporting filtered annotations to {json_file}')
+        with report_stage('export_json'):
+            export_json(filtered_file, json_file)
 
     # Remove any duplicates or negative labels 
-    print('Removing duplicates and negative labels')
-    annotations_df = clean_annotations(filtered_annotations)
-
-    # Propagate labels to root and save to file
-    print('Propagating annotations to ontology roots')
-    terms_df = propagate_terms(annotations_df, obo_file) 
-    # expand list of terms to that each one is in one row
-    all_terms = terms_df.explode('term').reset_index(drop=True) 
-    terms_file = os.path.join(save_location, 'terms.tsv')
-    print(f'Saving terms to file {terms_file}')
-    all_terms.to_csv(terms_file, index=False, sep='\t') 
-    
-
-    # Find taxonomies and save to file
-    taxdf = get_all_taxonomies(annotations_df)
-    taxonomy_file = os.path.join(save_location, 'taxonomy.tsv')
-    print(f'Saving terms to file {taxonomy_file}')
-    taxdf.to_csv(taxonomy_file, index=False, sep='\t') 
-
-    
-    # Find sequences and save to file
-    print('Finding sequences for annotated proteins')
-    records = find_sequences(all_terms, swissprot=swissprot_file, trembl=trembl_file, trembl_index=trembl_index_file)
-    seq_file_path = os.path.join(save_location,'sequences.fasta')
-    print('Saving sequences to file {}'.format(seq_file_path))
-    for r in records:
-        with open(seq_file_path, 'a') as handle:
-            SeqIO.write(r, handle, 'fasta')
-
+    stage_times = {}
+    start_time = time.time()
+    annotations_file, clean_key = clean_stage(cache_dir, filtered_file, filter_key)
+    stage_times['clean'] = time.time() - start_time
+
+    # The set of proteins is known once annotations are cleaned, so sequences are looked up in a
+    # background process while annotations are propagated and saved
+    print('Finding sequences for annotated proteins in the background')
+    sequence_files = [f for f in [swissprot_file, trembl_file] if f is not None]
+    # hashed here, so that only this process writes file_hashes.json and the background process just reads it
+    for sequence_file in sequence_files:
+        input_fingerprint(sequence_file, cache_dir)
+    executor = ProcessPoolExecutor(1)
+    sequences_future = executor.submit(sequence_stage, cache_dir, annotations_file, clean_key, sequence_files,
+                                       swissprot_file, trembl_file, trembl_index_file, args.workers)
+
+    # Propagate labels to root and save terms and taxonomies, with the same cached stages as process_goa.py.
+    # The taxonomies also list the proteins that only have obsolete terms
+    start_time = time.time()
+    outputs_location, release = label_stages(cache_dir, filtered_file, filter_key, obo_file,
+                                             clean=(annotations_file, clean_key), keep_unlabeled_taxonomy=True)
+    propagated_location, propagate_key = release['propagated'], release['propagate_key']
+    print(f'Saving terms and taxonomies to {save_location}')
+    publish(outputs_location, ['terms.tsv', 'taxonomy.tsv'], save_location)
+    stage_times['propagate and outputs'] = time.time() - start_time
+
+    # wait for the sequences of all cleaned annotations
+    start_time = time.time()
+    ((all_sequences_location, sequences_time), all_sequences_key), background_stages = sequences_future.result()
+    executor.shutdown()
+    add_stages(background_stages, background=True)
+    stage_times['sequences (waiting)'] = time.time() - start_time
+    stage_times['sequences (background)'] = sequences_time
+
+    def save_sequences(location):
+        # some proteins only have obsolete terms and no labels
+        rows, _, _ = load_propagated(propagated_location)
+        proteins = set(rows.EntryID.unique())
+        n_records = write_fasta_subset(os.path.join(all_sequences_location, 'sequences.fasta'), proteins,
+                                       os.path.join(location, 'sequences.fasta'))
+        report_rows(rows_in=len(proteins), rows_out=n_records)
+
+    # Keep the sequences of proteins with labels and save to file
+    sequences_location, sequences_key = run_stage(cache_dir, 'labeled_sequences', build=save_sequences,
+                                                  load=lambda location: location,
+                                                  depends=[all_sequences_key, propagate_key])
+    print('Saving sequences to file {}'.format(os.path.join(save_location, 'sequences.fasta')))
+    publish(sequences_location, ['sequences.fasta'], save_location)
+
+    # wall-clock time of each stage. Propagation and outputs overlapped with the sequence lookup
+    saved_time = sequences_time - stage_times['sequences (waiting)']
+    for stage, duration in stage_times.items():
+        print(f'{stage}: {duration:.1f}s')
+    print(f'Looking up sequences in the background saved {saved_time:.1f}s')
+
+    def save_sequence_store(location):
+        rows, _, _ = load_propagated(propagated_location)
+        build_sequence_store(os.path.join(sequences_location, 'sequences.fasta'), rows.EntryID.unique(),
+                             os.path.join(location, 'sequences.store'), rows=rows, dedup=args.dedup)
+
+    if args.sequence_store:
+        # one residue buffer with offsets, row-aligned with the labels
+        print('Packing sequences into arrays')
+        store_location, _ = run_stage(cache_dir, 'sequence_store', build=save_sequence_store,
+                                      load=lambda location: location, params={'dedup': args.dedup},
+                                      depends=[propagate_key, sequences_key])
+        print('Saving sequence store to {}'.format(os.path.join(save_location, 'sequences.store')))
+        publish(store_location, ['sequences.store'], save_location)
+    else:
+        remove_outputs(['sequences.store'], save_location)
 
+    finish_report()
@@ -0,0 +1,120 @@
+import os
+import json
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from parsers.obo_utils import read_ontology
+from parsers.goa_utils import propagate_matrix
+from parsers.label_utils import labels_to_frame, label_order, load_propagated
+from parsers.stage_cache import record_outputs
+
+
+# columns that identify an annotation when comparing releases
+ANNOTATION_KEY = ['DB_Object_ID', 'GO_ID', 'Evidence']
+
+
+def save_release(release, data_location):
+    """ Save the description of a processed release (see pipeline_utils.label_stages) to <data_location>/release.json,
+        so the next release can be processed incrementally from it """
+    with open(os.path.join(data_location, 'release.json'), 'w') as f:
+        json.dump(release, f, indent=1)
+    record_outputs(['release.json'], data_location)
+
+
+def load_release(data_location):
+    """ Load the description of a previous release saved by save_release, checking its cached files still exist """
+    release_file = os.path.join(data_location, 'release.json')
+    assert os.path.exists(release_file), f'{release_file} does not exist. Process the previous release with process_goa.py first'
+    with open(release_file) as f:
+        release = json.load(f)
+    for name in ['annotations', 'propagated']:
+        assert os.path.exists(release[name]), f'Cached {name} of the previous release {release[name]} no longer exists'
+    return release
+
+
+def annotation_changes(previous_df, annotations_df):
+    """
+    Annotations added and removed between two releases, compared on (protein, GO term, evidence code).
+
+    :param previous_df: cleaned annotations of the previous release
+    :param annotations_df: cleaned annotations of the new release
+    :return: (added, removed) DataFrames with the ANNOTATION_KEY columns
+    """
+    previous_keys = previous_df[ANNOTATION_KEY].astype(str).drop_duplicates()
+    keys = annotations_df[ANNOTATION_KEY].astype(str).drop_duplicates()
+    merged = previous_keys.merge(keys, how='outer', indicator=True)
+    added = merged.loc[merged._merge == 'right_only', ANNOTATION_KEY].reset_index(drop=True)
+    removed = merged.loc[merged._merge == 'left_only', ANNOTATION_KEY].reset_index(drop=True)
+    return added, removed
+
+
+def closure_changed(previous_ontology, ontology):
+    """ Whether propagation with ontology can give different labels than with previous_ontology:
+        the terms or the ancestor closure (is_a/part_of edges, obsoletions) changed """
+    if previous_ontology is None or len(previous_ontology.terms) != len(ontology.terms):
+        return True
+    if not np.array_equal(previous_ontology.terms, ontology.terms):
+        return True
+    return (previous_ontology.closure != ontology.closure).nnz > 0
+
+
+def label_changes(previous_labels, labels):
+    """
+    Labels added and removed for each protein.
+
+    :param previous_labels: labels of the previous release, as returned by label_utils.labels_to_frame
+    :param labels: labels of the new release
+    :return: DataFrame with columns EntryID, aspect, term and change ('added' or 'removed')
+    """
+    merged = previous_labels.merge(labels, how='outer', indicator=True)
+    merged = merged[merged._merge != 'both']
+    changelog = pd.DataFrame({'EntryID': merged.EntryID.values, 'aspect': merged.aspect.values,
+                              'term': merged.term.values,
+                              'change': np.where(merged._merge == 'right_only', 'added', 'removed')})
+    return changelog.sort_values(['EntryID', 'aspect', 'term']).reset_index(drop=True)
+
+
+def update_propagated(previous, annotations_df, ontology):
+    """
+    Propagate the annotations of a new release incrementally from the propagated labels of the previous one.
+    Only proteins with an added or removed annotation (see annotation_changes) are propagated again, and the
+    labels of all other proteins are copied from the previous release. If the ontology closure changed,
+    all annotations are propagated again.
+
+    :param previous: description of the previous release, see load_release
+    :param annotations_df: cleaned annotations of the new release
+    :param ontology: compiled Ontology of the new release
+    :return: (rows, terms, propagated, changelog) where (rows, terms, propagated) are the same as
+             goa_utils.propagate_matrix(annotations_df, ontology) and changelog the labels added and
+             removed for each protein, see label_changes
+    """
+    previous_rows, previous_terms, previous_propagated = load_propagated(previous['propagated'])
+    previous_df = pd.read_parquet(previous['annotations'], columns=ANNOTATION_KEY)
+    added, removed = annotation_changes(previous_df, annotations_df)
+    print(f'{len(added)} annotations added and {len(removed)} removed since the previous release')
+
+    previous_ontology = read_ontology(previous['ontology']) if os.path.isdir(previous['ontology']) else None
+    if closure_changed(previous_ontology, ontology):
+        print('Ontology changed since the previous release, propagating all annotations')
+        rows, terms, propagated = propagate_matrix(annotations_df, ontology)
+        changelog = label_changes(labels_to_frame(previous_rows, previous_terms, previous_propagated),
+                                  labels_to_frame(rows, terms, propagated))
+        return rows, terms, propagated, changelog
+
+    affected = pd.unique(np.concatenate([added.DB_Object_ID.values, removed.DB_Object_ID.values]))
+    print(f'Propagating annotations of {len(affected)} proteins')
+    affected_rows, terms, affected_propagated = propagate_matrix(
+        annotations_df[annotations_df.DB_Object_ID.isin(affected)], ontology)
+
+    # labels of the other proteins are unchanged
+    kept = np.flatnonzero(~previous_rows.EntryID.isin(affected).values)
+    rows = pd.concat([previous_rows.iloc[kept], affected_rows], ignore_index=True)
+    propagated = sp.vstack([previous_propagated[kept], affected_propagated]).tocsr()
+    order = label_order(rows)
+    rows, propagated = rows.iloc[order].reset_index(drop=True), propagated[order]
+    propagated.sort_indices()
+
+    changed = np.flatnonzero(previous_rows.EntryID.isin(affected).values)
+    changelog = label_changes(labels_to_frame(previous_rows.iloc[changed], previous_terms, previous_propagated[changed]),
+                              labels_to_frame(affected_rows, terms, affected_propagated))
+    return rows, terms, propagated, changelog
@@ -0,0 +1,132 @@
+import os
+import re
+import mmap
+import sqlite3
+from functools import partial
+from multiprocessing import Pool
+import numpy as np
+from parsers.stage_cache import atomic_directory
+
+
+# start of a fasta record and its key: the UniProt accession (second field of '>sp|P12345|NAME_HUMAN ...'),
+# or the first word of the header if it has no '|' separated fields
+HEADER_PATTERN = re.compile(rb'^>(?:[^|\s]*\|)?([^|\s]*)', re.MULTILINE)
+
+# approximate size of the part of the fasta file scanned by each task
+INDEX_CHUNK_SIZE = 256 * 1024**2
+
+
+def _scan_headers(byte_range, fasta_file):
+    """ Find the keys (fixed width bytes array) and offsets of the records that start in a (start, end) byte range
+        of a fasta file """
+    start, end = byte_range
+    keys, offsets = [], []
+    with open(fasta_file, 'rb') as handle:
+        with mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ) as filemap:
+            # '^' only matches at the start of a line, so records are never split between ranges
+            for match in HEADER_PATTERN.finditer(filemap, start):
+                if match.start() >= end:
+                    break
+                keys.append(match.group(1))
+                offsets.append(match.start())
+    return np.array(keys, dtype=bytes), np.array(offsets, dtype=np.int64)
+
+
+def build_fasta_index(fasta_file, index_file=None, workers=1, chunk_size=INDEX_CHUNK_SIZE):
+    """
+    Index a fasta file by UniProt accession. The file is memory-mapped and scanned for record headers
+    in chunks, optionally in parallel, and the index is saved as a directory of .npy arrays sorted by key:
+    keys.npy (fixed width bytes), offsets.npy and lengths.npy (int64, in bytes, like Bio.SeqIO.index_db).
+
+    :param fasta_file: fasta format file
+    :param index_file: directory to save the index to. Default is <fasta_file>.fidx
+    :param workers: number of processes used to scan the file
+    :param chunk_size: approximate size in bytes of the part of the file scanned by each task
+    :return: index, as returned by load_fasta_index
+    """
+    if index_file is None:
+        index_file = fasta_file + '.fidx'
+
+    size = os.path.getsize(fasta_file)
+    bounds = list(range(0, size, chunk_size)) + [size]
+    byte_ranges = list(zip(bounds[:-1], bounds[1:]))
+    scan = partial(_scan_headers, fasta_file=fasta_file)
+    if workers > 1:
+        with Pool(workers) as pool:
+            results = pool.map(scan, byte_ranges)
+    else:
+        results = [scan(byte_range) for byte_range in byte_ranges]
+
+    # keys of the chunks are widened to the longest key when they are joined
+    keys = np.concatenate([chunk_keys for chunk_keys, _ in results] + [np.zeros(0, dtype='S1')])
+    offsets = np.concatenate([chunk_offsets for _, chunk_offsets in results] + [np.zeros(0, dtype=np.int64)])
+    # each record runs until the next one starts
+    lengths = np.diff(np.append(offsets, size))
+
+    order = np.argsort(keys, kind='stable')
+    keys, offsets, lengths = keys[order], offsets[order], lengths[order]
+    if len(keys) > 1 and (keys[1:] == keys[:-1]).any():
+        duplicate = keys[1:][keys[1:] == keys[:-1]][0].decode()
+        raise ValueError(f'Duplicate key "{duplicate}" in {fasta_file}')
+
+    with atomic_directory(index_file) as tmp_index_file:
+        for name, array in [('keys', keys), ('offsets', offsets), ('lengths', lengths)]:
+            np.save(os.path.join(tmp_index_file, f'{name}.npy'), array)
+
+    return load_fasta_index(index_file)
+
+
+def is_fasta_index(index_file):
+    """ Whether index_file is an index created by build_fasta_index (rather than a SQLite index) """
+    return os.path.isdir(index_file) and os.path.exists(os.path.join(index_file, 'keys.npy'))
+
+
+def load_fasta_index(index_file):
+    """ Memory-map an index saved by build_fasta_index. Returns a (keys, offsets, lengths) tuple of arrays """
+    return tuple(np.load(os.path.join(index_file, f'{name}.npy'), mmap_mode='r')
+                 for name in ['keys', 'offsets', 'lengths'])
+
+
+def lookup_fasta_index(index, proteins):
+    """
+    Find the location of a set of proteins with a binary search of the sorted keys
+
+    :param index: (keys, offsets, lengths) tuple returned by load_fasta_index
+    :param proteins: list or set of protein accessions
+    :return: list of (key, offset, length) tuples of the proteins found, sorted by offset in the fasta file
+    """
+    keys, offsets, lengths = index
+    width = keys.dtype.itemsize
+    # longer accessions can't be in the index, and would be truncated when converted to the key dtype
+    query = np.unique(np.array([p.encode() for p in proteins if len(p.encode()) <= width], dtype=keys.dtype))
+    if len(keys) == 0 or len(query) == 0:
+        return []
+
+    positions = np.searchsorted(keys, query)
+    positions = positions[positions < len(keys)]
+    query = query[:len(positions)]
+    positions = positions[keys[positions] == query]
+
+    order = np.argsort(offsets[positions], kind='stable')
+    positions = positions[order]
+    return list(zip(np.char.decode(keys[positions]).tolist(), offsets[positions].tolist(), lengths[positions].tolist()))
+
+
+def export_sqlite(index, fasta_file, sqlite_file):
+    """ Save an index created by build_fasta_index in the SQLite format of Bio.SeqIO.index_db,
+        for tools that expect it """
+    keys, offsets, lengths = index
+    con = sqlite3.connect(sqlite_file)
+    con.execute('PRAGMA synchronous=OFF')
+    con.execute('CREATE TABLE meta_data (key TEXT, value TEXT);')
+    con.executemany('INSERT INTO meta_data (key, value) VALUES (?,?);',
+                    [('count', len(keys)), ('format', 'fasta'), ('filenames_relative_to_index', 'True')])
+    con.execute('CREATE TABLE file_data (file_number INTEGER, name TEXT);')
+    relative_name = os.path.relpath(os.path.abspath(fasta_file), os.path.dirname(os.path.abspath(sqlite_file)))
+    con.execute('INSERT INTO file_data (file_number, name) VALUES (?,?);', (0, relative_name.replace(os.path.sep, '/')))
+    con.execute('CREATE TABLE offset_data (key TEXT, file_number INTEGER, offset INTEGER, length INTEGER);')
+    con.executemany('INSERT INTO offset_data (key, file_number, offset, length) VALUES (?,?,?,?);',
+                    ((key.decode(), 0, int(offset), int(length)) for key, offset, length in zip(keys, offsets, lengths)))
+    con.execute('CREATE UNIQUE INDEX IF NOT EXISTS key_index ON offset_data(key);')
+    con.commit()
+    con.close()
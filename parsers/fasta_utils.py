@@ -1,34 +1,151 @@
+import gzip
+import mmap
 import sqlite3
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from Bio import SeqIO, SeqRecord, Seq
+from parsers.fasta_index import HEADER_PATTERN, is_fasta_index, load_fasta_index, lookup_fasta_index
 
 
-def read_fasta_sql(index_file, sequence_file, proteins):
+# number of records decoded together by each thread
+DECODE_BATCH = 1024
+
+
+def lookup_offsets(index_file, proteins):
+    """
+    Find the location of a set of proteins in a fasta file indexed into a sqlite
+    file by biopython's Bio.SeqIO.index_db method, or by fasta_index.build_fasta_index
+
+    :param index_file: SQLite index file, or index directory created by build_fasta_index
+    :param proteins: list or set of proteins to be matched. These must match the key function for the database
+    :return: list of (key, offset, length) tuples of the proteins found, sorted by offset in the fasta file
+    """
+    if is_fasta_index(index_file):
+        return lookup_fasta_index(load_fasta_index(index_file), proteins)
+
+    con = sqlite3.connect(index_file)
+    try:
+        # a single join against a temporary table of keys instead of one query per protein
+        con.execute('create temp table query_keys (key text primary key)')
+        con.executemany('insert or ignore into query_keys values (?)', ((p,) for p in proteins))
+        cursor = con.execute('select o.key, o.offset, o.length from query_keys q '
+                             'join offset_data o on o.key = q.key order by o.offset')
+        return cursor.fetchall()
+    finally:
+        con.close()
+
+
+def parse_fasta_record(raw_record, key):
+    """ Parse the bytes of a single fasta record into a biopython SeqRecord with ID key """
+    header, _, sequence = raw_record.partition(b'\n')
+    description = header.decode().rstrip('\r')[1:]
+    sequence = sequence.replace(b'\n', b'').replace(b'\r', b'').decode()
+    return SeqRecord.SeqRecord(Seq.Seq(sequence), description=description,
+                               id=key, name=description.split(' ')[0])
+
+
+def _parse_batch(filemap, batch):
+    return [parse_fasta_record(filemap[offset:offset+length], key) for key, offset, length in batch]
+
+
+def iter_fasta_sql(index_file, sequence_file, proteins, threads=1):
+    """
+    Find a set of proteins in a fasta sequence file that has been indexed into a
+    sqlite file by biopython's Bio.SeqIO.index_db method, or by fasta_index.build_fasta_index.
+
+    All proteins are looked up in the index at once and the records are read in file order
+    from a memory map of the fasta file, so the file is read sequentially.
+
+    :param index_file: SQLite index file for sequence_file, or index directory created by build_fasta_index
+    :param sequence_file: fasta format file with sequences indexed by index_file
+    :param proteins: list or set of proteins to be matched. These must match the key function for the database
+    :param threads: number of threads used to decode records. At most 2 * threads batches of DECODE_BATCH
+                    records are decoded ahead of the records yielded
+    :return: generator of matching records, in the order they appear in sequence_file.
+             Items are biopython SeqRecord objects
+    """
+    hits = lookup_offsets(index_file, proteins)
+    if not hits:
+        return
+    batches = [hits[i:i+DECODE_BATCH] for i in range(0, len(hits), DECODE_BATCH)]
+
+    with open(sequence_file, 'rb') as filehandle:
+        with mmap.mmap(filehandle.fileno(), 0, access=mmap.ACCESS_READ) as filemap:
+            if threads > 1:
+                # at most 2 batches per thread are decoded ahead of the consumer, so memory use does
+                # not grow with the number of proteins. Results are yielded in submission order
+                with ThreadPoolExecutor(threads) as executor:
+                    pending = deque()
+                    for batch in batches:
+                        if len(pending) == 2 * threads:
+                            yield from pending.popleft().result()
+                        pending.append(executor.submit(_parse_batch, filemap, batch))
+                    while pending:
+                        yield from pending.popleft().result()
+            else:
+                for batch in batches:
+                    yield from _parse_batch(filemap, batch)
+
+
+def read_fasta_sql(index_file, sequence_file, proteins, threads=1):
     """
     Find a set of proteins in a fasta sequence file that has been indexed into a
     sqlite file by biopython's Bio.SeqIO.index_db method
 
-    :param index_file: SQLite index file for sequence_file
+    :param index_file: SQLite index file for sequence_file, or index directory created by build_fasta_index
     :param sequence_file: fasta format file with sequences indexed by index_file
     :param proteins: list or set of proteins to be matched. These must match the key function for the database
+    :param threads: number of threads used to decode records
     :return: list of matching records. List items are a biopython SeqRecord object
     """
-    con = sqlite3.connect(index_file)
+    return list(iter_fasta_sql(index_file, sequence_file, proteins, threads=threads))
+
 
-    matching_records = [] 
-    with open(sequence_file, 'r') as filehandle:
-        for gene in set(proteins):
-            sql = f'select * from offset_data where key = "{gene}"'
-            cursor = con.execute(sql)
-            record = cursor.fetchone()
-            if record is not None:
-                offset = record[-2]
-                length = record[-1]
-                filehandle.seek(offset, 0)
-                seq_record = filehandle.read(length)
-                sequence = ''.join(seq_record.split('\n')[1:-1])
-                description = seq_record.split('\n')[0].split('>')[1]
-                rec=SeqRecord.SeqRecord(Seq.Seq(sequence), description=description, 
-                                        id=gene, name=description.split(' ')[0])
-                matching_records.append(rec)
-
-    return matching_records
+def iter_fasta_subset(sequence_file, proteins):
+    """
+    Stream through a fasta file once and keep only the records of a set of proteins.
+    Only the matching records are parsed, so memory use does not depend on the size of the file.
+
+    :param sequence_file: fasta format file, plain text or gzipped. Records are matched by UniProt
+                          accession (eg P12345 in '>sp|P12345|NAME_HUMAN ...')
+    :param proteins: set of proteins to be matched
+    :return: generator of matching records with ID set to the accession. Items are biopython SeqRecord objects
+    """
+    wanted = {p.encode() for p in proteins}
+    opener = gzip.open if sequence_file.endswith('.gz') else open
+    with opener(sequence_file, 'rb') as handle:
+        key, lines = None, []
+        for line in handle:
+            if line.startswith(b'>'):
+                if key is not None:
+                    yield parse_fasta_record(b''.join(lines), key.decode())
+                key = HEADER_PATTERN.match(line).group(1)
+                if key not in wanted:
+                    key = None
+                lines = [line]
+            elif key is not None:
+                lines.append(line)
+        if key is not None:
+            yield parse_fasta_record(b''.join(lines), key.decode())
+
+
+def write_fasta_subset(sequence_file, proteins, output_file):
+    """
+    Copy the records of a set of proteins from a fasta file to another one, as they are (without parsing them)
+
+    :param sequence_file: fasta format file. Records are matched by key as in iter_fasta_subset
+    :param proteins: set of proteins to be copied
+    :param output_file: fasta file to write the matching records to, in the order of sequence_file
+    :return: number of records written
+    """
+    wanted = {p.encode() for p in proteins}
+    n_records = 0
+    with open(sequence_file, 'rb') as handle, open(output_file, 'wb') as output:
+        keep = False
+        for line in handle:
+            if line.startswith(b'>'):
+                keep = HEADER_PATTERN.match(line).group(1) in wanted
+                n_records += keep
+            if keep:
+                output.write(line)
+    return n_records
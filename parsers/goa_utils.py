@@ -1,38 +1,466 @@
+import io
 import os
-import json
+import re
+import csv
+import gzip
+import hashlib
+import tempfile
+from collections import namedtuple
+from functools import partial
+from multiprocessing import Pool
 from tqdm import tqdm
 import pandas as pd
-from operator import itemgetter
-import obonet
-import GOA
-import networkx as nx
+import pyarrow as pa
+import pyarrow.parquet as pq
+import numpy as np
+import scipy.sparse as sp
+from parsers.obo_utils import Ontology, load_ontology
+from parsers.run_report import report_rows
 
+try:
+    import indexed_gzip
+except ImportError:
+    indexed_gzip = None
 
-def file_length(filename):
-    return sum(1 for line in open(filename, 'rb'))
 
+# GAF 2.x columns, named as in Bio.UniProt.GOA
+GAF_FIELDS = ['DB', 'DB_Object_ID', 'DB_Object_Symbol', 'Qualifier', 'GO_ID', 'DB:Reference',
+              'Evidence', 'With', 'Aspect', 'DB_Object_Name', 'Synonym', 'DB_Object_Type',
+              'Taxon_ID', 'Date', 'Assigned_By', 'Annotation_Extension', 'Gene_Product_Form_ID']
+# columns holding '|' separated values, split into lists the same way GOA.gafiterator does
+GAF_LIST_FIELDS = ['Qualifier', 'DB:Reference', 'With', 'Synonym', 'Taxon_ID']
 
-def filter_evidence(annot_file, save_location, highthr=True):
+# Parquet evidence cache: the GAF columns as strings plus the parsed qualifier and taxon columns
+CACHE_SCHEMA = pa.schema([(field, pa.string()) for field in GAF_FIELDS] +
+                         [('not_Qualifier', pa.bool_()), ('qualifier', pa.string()), ('species', pa.int64())])
+# columns of the cache needed by clean_annotations and the later steps
+ANNOTATION_COLUMNS = ['DB', 'DB_Object_ID', 'DB_Object_Symbol', 'GO_ID', 'Evidence', 'Aspect', 'DB_Object_Name',
+                      'DB_Object_Type', 'Date', 'Assigned_By', 'not_Qualifier', 'qualifier', 'species']
+# low cardinality columns loaded as categoricals
+CATEGORICAL_COLUMNS = ['DB', 'Evidence', 'Aspect', 'DB_Object_Type', 'Assigned_By', 'qualifier']
 
-    exp_evidence = ['EXP', 'IPI', 'IDA', 'IMP', 'IGI', 'IEP']
-    inferred_evidence = ['TAS', 'IC']
-    h_evidence = ['HTP', 'HDA', 'HMP', 'HGI', 'HEP']
-    ok_evidence = exp_evidence + inferred_evidence
-    if highthr:
-        ok_evidence += h_evidence
-    
-    gaf_filelen = file_length(annot_file)
+# GAF aspect codes and the name of the corresponding subontology
+ASPECT_CODES = {'P': 0, 'C': 1, 'F': 2}
+SUBONTOLOGIES = ['BPO', 'CCO', 'MFO']
 
-    with open(annot_file) as handle, open(save_location, 'a', newline='') as f:
-        pbar = tqdm(GOA.gafiterator(handle), total=gaf_filelen, unit_scale=True)
-        for rec in pbar:
-            if rec['Evidence'] in ok_evidence and rec['DB']=='UniProtKB':
-                # save full records
-                #with open(save_location, 'a', newline='') as f:
-                json.dump(rec, f)
-                f.write(os.linesep)
+# obsolete terms with a one-to-one replacement, checked manually in AmiGO (see README)
+OBSOLETE_REPLACE = {'GO:0006975':'GO:0042770',
+                    'GO:0031617':'GO:0000776',
+                    'GO:1901720':'GO:1905560',
+                    'GO:0034291':'GO:0140911',
+                    'GO:0034290':'GO:0140911',
+                    'GO:0034292':'GO:0140911',
+                    'GO:0004147':'GO:0043754',
+                    'GO:0044662':'GO:0051673',
+                    'GO:0044649':'GO:0051715',
+                    'GO:0050828':'GO:0043129',
+                    'GO:1990142':'GO:0044179',
+                    'GO:0102430':'GO:0102431',
+                    'GO:0006295': 'GO:0006289',
+                    'GO:0006296': 'GO:0006289',
+                    'GO:0006875': 'GO:0030003',
+                    'GO:0008022': 'GO:0005515',
+                    'GO:0008852': 'GO:0008310',
+                    'GO:0008853': 'GO:0008311',
+                    'GO:0030004': 'GO:0030003',
+                    'GO:0030320': 'GO:0030002',
+                    'GO:0031997': 'GO:0005515',
+                    'GO:0032199': 'GO:0032197',
+                    'GO:0033683': 'GO:0006289',
+                    'GO:0046916': 'GO:0030003',
+                    'GO:0047485': 'GO:0005515',
+                    'GO:0072507': 'GO:0055080',
+                    'GO:0097056': 'GO:0001717',
+                    'GO:1904608': 'GO:1902065',
+                    'GO:1990731': 'GO:0070914'}
 
-    return pd.read_json(save_location, lines=True)
+# evidence codes, see http://geneontology.org/docs/guide-go-evidence-codes/
+EXP_EVIDENCE = ['EXP', 'IPI', 'IDA', 'IMP', 'IGI', 'IEP']
+INFERRED_EVIDENCE = ['TAS', 'IC']
+HTP_EVIDENCE = ['HTP', 'HDA', 'HMP', 'HGI', 'HEP']
+# groups of evidence codes that can be named in a profile definition, see parse_profile
+EVIDENCE_GROUPS = {'exp': EXP_EVIDENCE, 'inferred': INFERRED_EVIDENCE, 'high': HTP_EVIDENCE}
+
+# A filtering profile keeps the annotations from UniProtKB with one of its evidence codes
+# and not assigned by one of its excluded sources (Assigned_By column)
+EvidenceProfile = namedtuple('EvidenceProfile', ['evidence', 'excluded_sources'])
+EVIDENCE_PROFILES = {'exp': EvidenceProfile(EXP_EVIDENCE + INFERRED_EVIDENCE, []),
+                     'exp_high': EvidenceProfile(EXP_EVIDENCE + INFERRED_EVIDENCE + HTP_EVIDENCE, [])}
+# outputs of a profile are saved to <dest>/<name>/, so names are plain directory names other than these
+PROFILE_NAME_PATTERN = re.compile(r'[A-Za-z0-9_][A-Za-z0-9_.-]*')
+RESERVED_PROFILE_NAMES = ['cache', 'snapshots', 'labels', 'raw_data']
+
+# Annotations kept while the GAF file is read, before they are saved: taxa is a set of raw Taxon_ID values
+# (eg. 'taxon:9606') matched with the first taxon of each annotation and proteins a set of DB_Object_ID values.
+# None keeps all taxa or proteins. See make_scope
+Scope = namedtuple('Scope', ['taxa', 'proteins'])
+
+# size of the blocks of raw GAF text parsed at once
+CHUNK_SIZE = 64 * 1024**2
+
+
+def gzip_index_file(annot_file, index_dir=None):
+    """ Seek point index file of a gzipped GAF file, in index_dir (default the temporary directory).
+        Its name includes a hash of the path, size and modification time of the GAF file, so the index of
+        an older version of the file is never used """
+    stat = os.stat(annot_file)
+    key = hashlib.sha256(f'{os.path.abspath(annot_file)}:{stat.st_size}:{stat.st_mtime_ns}'.encode()).hexdigest()
+    return os.path.join(index_dir if index_dir is not None else tempfile.gettempdir(),
+                        f'{os.path.basename(annot_file)}-{key[:16]}.gzidx')
+
+
+def open_gaf(annot_file, seekable=False, index_dir=None):
+    """ Open a GAF file for binary reading. Gzipped files are decompressed as they are read.
+        With seekable=True and indexed_gzip installed, gzipped files are opened with a seek point index
+        (saved in index_dir, see gzip_index_file) so that they can be split into byte ranges """
+    if not annot_file.endswith('.gz'):
+        return open(annot_file, 'rb')
+    if not seekable or indexed_gzip is None:
+        return gzip.open(annot_file, 'rb')
+
+    index_file = gzip_index_file(annot_file, index_dir)
+    if os.path.exists(index_file):
+        try:
+            return indexed_gzip.IndexedGzipFile(annot_file, index_file=index_file)
+        except indexed_gzip.ZranError:
+            print(f'Seek point index {index_file} does not match {annot_file}, building it again')
+    handle = indexed_gzip.IndexedGzipFile(annot_file)
+    handle.build_full_index()
+    os.makedirs(os.path.dirname(index_file), exist_ok=True)
+    # exported under a temporary name, so other processes never read a partial index
+    tmp_file = f'{index_file}.tmp{os.getpid()}'
+    handle.export_index(tmp_file)
+    os.replace(tmp_file, index_file)
+    return handle
+
+
+def is_seekable(annot_file):
+    """ Whether open_gaf can seek to arbitrary (uncompressed) offsets in this file """
+    return not annot_file.endswith('.gz') or indexed_gzip is not None
+
+
+def gaf_size(annot_file, index_dir=None):
+    """ Size of the (uncompressed) contents of a seekable GAF file in bytes """
+    if not annot_file.endswith('.gz'):
+        return os.path.getsize(annot_file)
+    with open_gaf(annot_file, seekable=True, index_dir=index_dir) as handle:
+        handle.seek(0, os.SEEK_END)
+        return handle.tell()
+
+
+def gaf_byte_ranges(annot_file, n_ranges, index_dir=None):
+    """ Split a seekable GAF file into n_ranges (start, end) byte ranges that begin and end on line boundaries """
+    size = gaf_size(annot_file, index_dir=index_dir)
+    bounds = [0]
+    with open_gaf(annot_file, seekable=True, index_dir=index_dir) as handle:
+        for i in range(1, n_ranges):
+            position = max(size * i // n_ranges, bounds[-1])
+            if position > 0:
+                # move to the start of the next line, unless position is already at one
+                handle.seek(position - 1)
+                position += len(handle.readline()) - 1
+            bounds.append(min(position, size))
+    bounds.append(size)
+    return [(start, end) for start, end in zip(bounds[:-1], bounds[1:]) if end > start]
+
+
+def read_gaf_blocks(handle, chunk_size=CHUNK_SIZE, end=None):
+    """ Read a binary file handle in blocks of roughly chunk_size bytes that
+        always end on a line boundary. If end is given, stop reading at that offset """
+    remainder = b''
+    while True:
+        size = chunk_size if end is None else min(chunk_size, end - handle.tell())
+        block = handle.read(size) if size > 0 else b''
+        if not block:
+            break
+        block = remainder + block
+        cut = block.rfind(b'\n') + 1
+        remainder = block[cut:]
+        if cut:
+            yield block[:cut]
+    if remainder:
+        yield remainder
+
+
+def parse_gaf_block(block):
+    """ Parse a block of complete GAF lines into a DataFrame with one string column per GAF field.
+        Header and comment lines (starting with '!') are skipped """
+    if block.startswith(b'!') or b'\n!' in block:
+        block = b''.join(line for line in block.splitlines(keepends=True) if not line.startswith(b'!'))
+    if not block.strip():
+        return pd.DataFrame(columns=GAF_FIELDS, dtype=str)
+    return pd.read_csv(io.BytesIO(block), sep='\t', header=None, names=GAF_FIELDS, dtype=str,
+                       na_filter=False, quoting=csv.QUOTE_NONE, encoding='utf-8')
+
+
+def parse_profile(definition):
+    """
+    Parse a filtering profile given as the name of a profile in EVIDENCE_PROFILES, or as
+    name=item,item,... where each item is an evidence code (eg. IEA), a group of codes in EVIDENCE_GROUPS
+    (exp, inferred or high) or a source to exclude prefixed with '!' (eg. !InterPro).
+    For example 'exp_iea=exp,inferred,IEA,!InterPro'
+
+    :return: (name, EvidenceProfile)
+    """
+    if '=' not in definition:
+        assert definition in EVIDENCE_PROFILES, \
+            f'Unknown profile {definition}, use one of {", ".join(EVIDENCE_PROFILES)} or name=codes'
+        return definition, EVIDENCE_PROFILES[definition]
+
+    name, items = definition.split('=', 1)
+    assert PROFILE_NAME_PATTERN.fullmatch(name) and name not in RESERVED_PROFILE_NAMES, \
+        f'Invalid profile name "{name}": use letters, digits, "_", and "-" or "." after the first character, ' \
+        f'and none of {", ".join(RESERVED_PROFILE_NAMES)}'
+    evidence, excluded_sources = [], []
+    for item in filter(None, items.split(',')):
+        if item.startswith('!'):
+            excluded_sources.append(item[1:])
+        else:
+            evidence.extend(EVIDENCE_GROUPS.get(item, [item]))
+    return name, EvidenceProfile(evidence, excluded_sources)
+
+
+def parse_profiles(definitions):
+    """ Parse a list of profile definitions (see parse_profile) into a dict of profile name to EvidenceProfile.
+        Each name can only be given once """
+    profiles = [parse_profile(definition) for definition in definitions]
+    names = [name for name, _ in profiles]
+    duplicates = sorted({name for name in names if names.count(name) > 1})
+    assert not duplicates, f'Profile names given more than once: {", ".join(duplicates)}'
+    return dict(profiles)
+
+
+def make_scope(taxa=None, proteins_file=None):
+    """
+    Scope of the annotations to keep, or None to keep all annotations
+
+    :param taxa: list of NCBI taxon IDs, eg. [9606, 10090]
+    :param proteins_file: text file with one UniProt accession per line (only the first word of a line is used)
+    :return: Scope
+    """
+    if taxa is None and proteins_file is None:
+        return None
+    proteins = None
+    if proteins_file is not None:
+        with open(proteins_file) as f:
+            proteins = frozenset(line.split()[0] for line in f if line.strip())
+    return Scope(frozenset(f'taxon:{taxon}' for taxon in taxa) if taxa is not None else None, proteins)
+
+
+def scope_mask(gaf_df, scope):
+    """ Boolean mask of the rows in a Scope, checked on the raw GAF columns with hash lookups """
+    mask = np.ones(len(gaf_df), dtype=bool)
+    if scope.proteins is not None:
+        mask &= gaf_df.DB_Object_ID.isin(scope.proteins).values
+    if scope.taxa is not None:
+        taxon = gaf_df.Taxon_ID
+        in_taxa = taxon.isin(scope.taxa).values
+        # annotations with an interacting taxon ('taxon:9606|taxon:562') are matched on their first taxon
+        multiple = np.flatnonzero(mask & ~in_taxa & taxon.str.contains('|', regex=False).values)
+        in_taxa[multiple] = taxon.iloc[multiple].str.split('|', n=1).str[0].isin(scope.taxa).values
+        mask &= in_taxa
+    return mask
+
+
+def evidence_mask(gaf_df, ok_evidence):
+    """ Boolean mask of the rows with an accepted evidence code from UniProtKB """
+    return gaf_df.Evidence.isin(ok_evidence).values & (gaf_df.DB.values == 'UniProtKB')
+
+
+def profile_mask(gaf_df, profile):
+    """ Boolean mask of the rows kept by an EvidenceProfile """
+    mask = evidence_mask(gaf_df, profile.evidence)
+    if profile.excluded_sources:
+        mask &= ~gaf_df.Assigned_By.isin(profile.excluded_sources).values
+    return mask
+
+
+def filter_block(block, profiles, scope=None):
+    """ Rows of a block of raw GAF lines kept by each profile. The block is parsed once for all profiles
+
+    :param profiles: dict of profile name to EvidenceProfile
+    :param scope: optional Scope of the rows to keep, see make_scope
+    :return: dict of profile name to DataFrame of kept rows
+    """
+    gaf_df = parse_gaf_block(block)
+    if scope is not None:
+        gaf_df = gaf_df[scope_mask(gaf_df, scope)]
+    return {name: gaf_df[profile_mask(gaf_df, profile)] for name, profile in profiles.items()}
+
+
+def _filter_sized_block(block, profiles, scope=None):
+    return len(block), filter_block(block, profiles, scope)
+
+
+def _filter_byte_range(byte_range, annot_file, profiles, chunk_size, scope=None, index_dir=None):
+    """ Filter one (start, end) byte range of a seekable GAF file. Runs in a worker process """
+    start, end = byte_range
+    with open_gaf(annot_file, seekable=True, index_dir=index_dir) as handle:
+        handle.seek(start)
+        kept = [filter_block(block, profiles, scope) for block in read_gaf_blocks(handle, chunk_size, end=end)]
+    return end - start, {name: pd.concat([block_kept[name] for block_kept in kept], ignore_index=True)
+                         if kept else pd.DataFrame(columns=GAF_FIELDS, dtype=str) for name in profiles}
+
+
+def scan_gaf(annot_file, profiles, chunk_size=CHUNK_SIZE, workers=1, scope=None, index_dir=None):
+    """
+    Filter a (possibly gzipped) GAF file with one or more profiles in a single read, optionally with
+    a pool of worker processes.
+
+    Seekable files are split into line-aligned byte ranges that are filtered independently.
+    Gzipped files without a seek index are decompressed in a single stream and their blocks
+    are handed out to the workers.
+
+    :param annot_file: path to GAF file, plain text or gzipped
+    :param profiles: dict of profile name to EvidenceProfile
+    :param chunk_size: approximate size in bytes of the blocks of text parsed at once
+    :param workers: number of worker processes. With 1 (default) the file is filtered in this process
+    :param scope: optional Scope of the rows to keep, see make_scope. Rows out of the scope are dropped
+                  right after parsing
+    :param index_dir: directory of the seek point indexes of gzipped files, see gzip_index_file
+    :return: generator of (bytes read, dict of profile name to DataFrame of kept rows), in file order
+    """
+    if workers <= 1:
+        with open_gaf(annot_file) as handle:
+            for block in read_gaf_blocks(handle, chunk_size):
+                yield _filter_sized_block(block, profiles, scope)
+        return
+
+    with Pool(workers) as pool:
+        if is_seekable(annot_file):
+            # a few ranges per worker keep the workers busy and the progress bar moving
+            n_ranges = max(workers, gaf_size(annot_file, index_dir=index_dir) // (4 * chunk_size) + 1)
+            task = partial(_filter_byte_range, annot_file=annot_file, profiles=profiles, chunk_size=chunk_size,
+                           scope=scope, index_dir=index_dir)
+            # imap returns the shards in file order, so the merged output is deterministic
+            yield from pool.imap(task, gaf_byte_ranges(annot_file, n_ranges, index_dir=index_dir))
+        else:
+            with open_gaf(annot_file) as handle:
+                task = partial(_filter_sized_block, profiles=profiles, scope=scope)
+                yield from pool.imap(task, read_gaf_blocks(handle, chunk_size))
+
+
+def to_records(gaf_df):
+    """ Split the multi-valued GAF columns into lists, matching the records from GOA.gafiterator """
+    gaf_df = gaf_df.copy()
+    for column in GAF_LIST_FIELDS:
+        gaf_df[column] = gaf_df[column].str.split('|')
+    return gaf_df
+
+
+def parse_qualifier_taxon(qualifier, taxon):
+    """ Parse '|' separated Qualifier and Taxon_ID strings with vectorized string operations:
+        not_Qualifier is True for negative ('NOT') annotations, qualifier is the last qualifier entry
+        and species is the numeric taxon ID of the first taxon, eg 'taxon:9606' becomes 9606
+
+    :param qualifier: Series of Qualifier strings
+    :param taxon: Series of Taxon_ID strings
+    :return: dict of not_Qualifier, qualifier and species Series
+    """
+    return {'not_Qualifier': qualifier.str.contains(r'(?:^|\|)NOT(?:\||$)', regex=True),
+            'qualifier': qualifier.str.rsplit('|', n=1).str[-1],
+            'species': taxon.str.split('|', n=1).str[0].str.rsplit(':', n=1).str[-1].astype('int64')}
+
+
+def to_columnar(gaf_df):
+    """ Convert filtered GAF rows (string columns) to an arrow table for the evidence cache.
+        The qualifier and taxon columns are parsed once here (see parse_qualifier_taxon)
+        instead of every time the cache is loaded """
+    columns = gaf_df.assign(**parse_qualifier_taxon(gaf_df.Qualifier, gaf_df.Taxon_ID))
+    return pa.Table.from_pandas(columns, schema=CACHE_SCHEMA, preserve_index=False)
+
+
+def load_annotations(filtered_file, columns=ANNOTATION_COLUMNS):
+    """
+    Load filtered annotations saved by filter_evidence.
+
+    :param filtered_file: Parquet evidence cache, or a JSON lines export (ending in .json)
+    :param columns: columns to read from the Parquet cache. By default only the columns used by
+                    clean_annotations and the later steps are read. Use None to read all columns
+    :return: DataFrame of annotations. Low cardinality string columns are categorical
+    """
+    if filtered_file.endswith('.json'):
+        return pd.read_json(filtered_file, lines=True)
+    read_dictionary = [c for c in CATEGORICAL_COLUMNS if columns is None or c in columns]
+    table = pq.read_table(filtered_file, columns=columns, read_dictionary=read_dictionary)
+    return table.to_pandas()
+
+
+def filter_evidence(annot_file, save_location, highthr=True, chunk_size=CHUNK_SIZE, workers=1, json_file=None,
+                    load=True, scope=None, index_dir=None):
+    """
+    Keep the annotations from UniProtKB with experimental, inferred (TAS, IC) and optionally
+    high-throughput evidence codes, and save them to a Parquet file.
+
+    :param annot_file: GAF file, plain text or gzipped
+    :param save_location: Parquet file where filtered annotations are saved
+    :param highthr: include high-throughput evidence codes
+    :param chunk_size: approximate size in bytes of the blocks of text parsed at once
+    :param workers: number of processes used to filter the GAF file
+    :param json_file: optional file to also export the filtered records to, in JSON lines format
+    :param load: load the saved annotations when done. If False, None is returned and memory use
+                 stays bounded by chunk_size
+    :param scope: optional Scope (taxa and/or proteins) of the annotations to keep, see make_scope
+    :param index_dir: directory of the seek point indexes of gzipped files, see gzip_index_file
+    :return: DataFrame of filtered annotations, as returned by load_annotations
+    """
+    profile = EVIDENCE_PROFILES['exp_high' if highthr else 'exp']
+    filter_profiles(annot_file, {'evidence': save_location}, {'evidence': profile}, chunk_size=chunk_size,
+                    workers=workers, json_files={'evidence': json_file} if json_file is not None else None,
+                    scope=scope, index_dir=index_dir)
+
+    if load:
+        return load_annotations(save_location)
+
+
+def filter_profiles(annot_file, save_locations, profiles, chunk_size=CHUNK_SIZE, workers=1, json_files=None,
+                    scope=None, index_dir=None):
+    """
+    Filter a GAF file with several profiles in a single read, saving the annotations kept by each profile
+    to its own Parquet file. Memory use stays bounded by chunk_size.
+
+    :param annot_file: GAF file, plain text or gzipped
+    :param save_locations: dict of profile name to Parquet file where its annotations are saved
+    :param profiles: dict of profile name to EvidenceProfile, see parse_profile
+    :param chunk_size: approximate size in bytes of the blocks of text parsed at once
+    :param workers: number of processes used to filter the GAF file
+    :param json_files: optional dict of profile name to file to also export its records to, in JSON lines format
+    :param scope: optional Scope (taxa and/or proteins) of the annotations to keep, see make_scope
+    :param index_dir: directory of the seek point indexes of gzipped files, see gzip_index_file
+    """
+    # progress is measured in (uncompressed) bytes read, so there is no need to count lines first
+    split = workers > 1 and is_seekable(annot_file)
+    total = gaf_size(annot_file, index_dir=index_dir) if split or not annot_file.endswith('.gz') else None
+    writers = {name: pq.ParquetWriter(save_locations[name], CACHE_SCHEMA) for name in profiles}
+    json_handles = {name: open(json_file, 'w', newline='') for name, json_file in (json_files or {}).items()}
+    pbar = tqdm(total=total, unit='B', unit_scale=True)
+    gaf_bytes, n_kept = 0, 0
+    for n_bytes, kept_profiles in scan_gaf(annot_file, profiles, chunk_size=chunk_size, workers=workers, scope=scope,
+                                           index_dir=index_dir):
+        for name, kept in kept_profiles.items():
+            n_kept += len(kept)
+            if len(kept):
+                writers[name].write_table(to_columnar(kept))
+                if name in json_handles:
+                    # save full records
+                    json_handles[name].write(to_records(kept).to_json(orient='records', lines=True).rstrip('\n')
+                                             + os.linesep)
+        pbar.update(n_bytes)
+        gaf_bytes += n_bytes
+    pbar.close()
+    for handle in list(writers.values()) + list(json_handles.values()):
+        handle.close()
+    report_rows(rows_out=n_kept, gaf_bytes=gaf_bytes)
+
+
+def export_json(filtered_file, json_file, batch_size=1000000):
+    """ Export the annotations of a Parquet evidence cache as JSON lines records, in the same format as
+        filter_evidence(..., json_file=json_file) """
+    with open(json_file, 'w', newline='') as f:
+        for batch in pq.ParquetFile(filtered_file).iter_batches(batch_size=batch_size, columns=GAF_FIELDS):
+            records = to_records(batch.to_pandas())
+            if len(records):
+                f.write(records.to_json(orient='records', lines=True).rstrip('\n') + os.linesep)
 
 
 def clean_annotations(filtered_annotations):
@@ -40,20 +468,37 @@ def clean_annotations(filtered_annotations):
         some terms (rows) are duplicated. We will get rid of these duplicates
         and other columns we don't need, in particular columns that have lists
         as values, which will prevent pandas from finding duplicates. 
-        We will also get rid of any negative labels ('NOT' in the qualifier)"""
+        We will also get rid of any negative labels ('NOT' in the qualifier)
+
+        String columns are returned as categoricals, and duplicates are found on their integer codes """
 
     annotations_df = filtered_annotations.drop(['DB:Reference', 'Synonym', 'With',
-                                                'Annotation_Extension', 'Gene_Product_Form_ID'], axis=1)
+                                                'Annotation_Extension', 'Gene_Product_Form_ID'],
+                                               axis=1, errors='ignore')
+
+    # Annotations loaded from the Parquet cache already have parsed qualifiers and taxon IDs.
+    # Records from the JSON export still have list valued Qualifier and Taxon_ID columns,
+    # eg. ['NOT', 'enables'] and ['taxon:9606'], which are joined back to GAF strings to be parsed
+    if 'not_Qualifier' not in annotations_df:
+        annotations_df = annotations_df.assign(**parse_qualifier_taxon(annotations_df.Qualifier.str.join('|'),
+                                                                       annotations_df.Taxon_ID.str.join('|')))
 
-    # The Qualifier column is a list that can contain two entries if the terms is NOT something
-    annotations_df['not_Qualifier'] = annotations_df.Qualifier.apply(lambda x: 'NOT' in x)
-    annotations_df['qualifier'] = annotations_df.Qualifier.apply(lambda x: x[-1])
+    annotations_df = annotations_df.drop(['Qualifier', 'Taxon_ID'], axis=1, errors='ignore')
 
-    # process taxonID to get just the number, eg '[taxon:9606]' becomes '9606'
-    annotations_df['species']=annotations_df.Taxon_ID.apply(lambda x: x[0].split(':')[-1])
+    # dictionary encode string columns
+    string_columns = [column for column in annotations_df if annotations_df[column].dtype == object]
+    string_memory = annotations_df[string_columns].memory_usage(index=False, deep=True).sum()
+    annotations_df = annotations_df.astype({column: 'category' for column in string_columns})
+    category_memory = annotations_df[string_columns].memory_usage(index=False, deep=True).sum()
+    print(f'Encoded {len(string_columns)} string columns as categoricals, saving '
+          f'{(string_memory - category_memory)/1024**2:.1f} MB ({string_memory/1024**2:.1f} MB -> '
+          f'{category_memory/1024**2:.1f} MB)')
 
-    annotations_df = annotations_df.drop(['Qualifier', 'Taxon_ID'],axis=1)
-    annotations_df = annotations_df.drop_duplicates()
+    # find duplicates on integer codes instead of comparing strings
+    codes = pd.DataFrame({column: annotations_df[column].cat.codes
+                          if isinstance(annotations_df[column].dtype, pd.CategoricalDtype)
+                          else annotations_df[column] for column in annotations_df})
+    annotations_df = annotations_df[~codes.duplicated().values]
 
     # Exclude negative lables 
     annotations_df = annotations_df[~annotations_df.not_Qualifier]
@@ -61,71 +506,86 @@ def clean_annotations(filtered_annotations):
     return annotations_df 
 
 
-def propagate_terms(df, obo_file):
-    obsolete_replace={'GO:0006975':'GO:0042770',
-                     'GO:0031617':'GO:0000776',
-                     'GO:1901720':'GO:1905560',
-                     'GO:0034291':'GO:0140911',
-                     'GO:0034290':'GO:0140911',
-                     'GO:0034292':'GO:0140911',
-                     'GO:0004147':'GO:0043754',
-                     'GO:0044662':'GO:0051673',
-                     'GO:0044649':'GO:0051715',
-                     'GO:0050828':'GO:0043129',
-                     'GO:1990142':'GO:0044179',
-                     'GO:0102430':'GO:0102431',
-                     'GO:0006295': 'GO:0006289',
-                     'GO:0006296': 'GO:0006289',
-                     'GO:0006875': 'GO:0030003',
-                     'GO:0008022': 'GO:0005515',
-                     'GO:0008852': 'GO:0008310',
-                     'GO:0008853': 'GO:0008311',
-                     'GO:0030004': 'GO:0030003',
-                     'GO:0030320': 'GO:0030002',
-                     'GO:0031997': 'GO:0005515',
-                     'GO:0032199': 'GO:0032197',
-                     'GO:0033683': 'GO:0006289',
-                     'GO:0046916': 'GO:0030003',
-                     'GO:0047485': 'GO:0005515',
-                     'GO:0072507': 'GO:0055080',
-                     'GO:0097056': 'GO:0001717',
-                     'GO:1904608': 'GO:1902065',
-                     'GO:1990731': 'GO:0070914'}
-
-    # load graph
-    obonet_graph = obonet.read_obo(obo_file)
-    # keep only "is_a" and "part_of" edges
-    remove_edges = [(i, j, k) for i, j, k in obonet_graph.edges if not(k=="is_a" or k=="part_of")]
-    obonet_graph.remove_edges_from(remove_edges)
+def category_codes(column):
+    """ Column as a categorical, so it can be processed through its integer codes """
+    if isinstance(column.dtype, pd.CategoricalDtype):
+        return column
+    return column.astype('category')
+
+
+def propagate_matrix(df, obo_file):
+    """
+    Propagate the annotations of each protein to all ancestor terms in the ontology, separately for each aspect.
+    Obsolete terms are replaced by their replacement term when there is one and removed otherwise.
+
+    Each (aspect, protein) pair becomes a row of a sparse incidence matrix of annotated terms, which is
+    multiplied by the ancestor closure of the ontology to propagate all aspects at once.
+
+    :param df: cleaned annotations with columns DB_Object_ID, GO_ID and Aspect
+    :param obo_file: OBO file of the ontology. Its compiled form is cached next to it (see obo_utils.load_ontology).
+                     An already loaded Ontology can also be given
+    :return: (rows, terms, propagated) where rows is a DataFrame with the EntryID and aspect (BPO, CCO or MFO)
+             of each row, terms the array of ontology term IDs of the columns and propagated a sparse boolean
+             CSR matrix of shape (len(rows), len(terms)). Rows are sorted by aspect and EntryID.
+    """
+    # load compiled graph with the precomputed ancestors of every term
+    ontology = obo_file if isinstance(obo_file, Ontology) else load_ontology(obo_file)
+    terms, closure = ontology.terms, ontology.closure
+
+    # Map the categories of each column instead of every row. Code -1 (missing value) maps to the appended -1
+    go_ids = category_codes(df.GO_ID)
+    aspects = category_codes(df.Aspect)
+    proteins = category_codes(df.DB_Object_ID)
 
     # replace obsolete
-    df.GO_ID = df.GO_ID.replace(obsolete_replace)
-    # remove remaining obsolete
-    obsolete_remove = set(df.GO_ID.values).difference(set(obonet_graph.nodes))
+    go_categories = go_ids.cat.categories.map(lambda term: OBSOLETE_REPLACE.get(term, term))
+    # remove remaining obsolete, ie. terms that are not in the graph
+    term_codes = np.append(pd.Index(terms).get_indexer(go_categories), -1).astype(np.int64)[go_ids.cat.codes.values]
+    aspect_codes = np.append(np.array([ASPECT_CODES.get(aspect, -1) for aspect in aspects.cat.categories],
+                                      dtype=np.int64), -1)[aspects.cat.codes.values]
+    annotated = (term_codes >= 0) & (aspect_codes >= 0)
+    if not annotated.any():
+        # no annotations, or only obsolete terms
+        return (pd.DataFrame({'EntryID': pd.Series(dtype=object), 'aspect': pd.Series(dtype=object)}),
+                np.asarray(terms), sp.csr_matrix((0, len(terms)), dtype=bool))
+
+    # one row per (aspect, protein), in aspect order and sorted by protein ID
+    protein_order = proteins.cat.categories.argsort()
+    protein_rank = np.empty(len(protein_order), dtype=np.int64)
+    protein_rank[protein_order] = np.arange(len(protein_order))
+    pair_codes = aspect_codes[annotated] * len(protein_order) + protein_rank[proteins.cat.codes.values[annotated]]
+    pairs, row_codes = np.unique(pair_codes, return_inverse=True)
+    rows = pd.DataFrame({'EntryID': proteins.cat.categories[protein_order].values[pairs % len(protein_order)],
+                         'aspect': np.array(SUBONTOLOGIES)[pairs // len(protein_order)]})
 
-    # look up ancestors once to save time
-    ancestor_lookup = {t: nx.descendants(obonet_graph,t) for t in df.GO_ID.unique()
-                       if t in obonet_graph}
-    obsolete_lookup = {t: set() for t in obsolete_remove}
-    ancestor_lookup.update(obsolete_lookup)
+    print(f'Processing {", ".join(SUBONTOLOGIES)} annotations')
+    incidence = sp.csr_matrix((np.ones(len(row_codes), dtype=bool), (row_codes, term_codes[annotated])),
+                              shape=(len(rows), len(terms)))
+    propagated = (incidence @ closure).tocsr()
+    propagated.sort_indices()
 
-    propagated_terms = []
-    for aspect, subontology in zip(['P','C','F'], ['BPO', 'CCO', 'MFO']):
+    # genes that only had obsolete terms have no row
+    return rows, np.asarray(terms), propagated
 
-        print(f'Processing {subontology} annotations')
 
-        for gene, annotations in df[df.Aspect==aspect].groupby('DB_Object_ID'):
-            terms = annotations.GO_ID.values
-            if len(set(terms)) > 1:
-                gene_terms = set(terms).union(*itemgetter(*set(terms))(ancestor_lookup))
-            else:
-                gene_terms = set([terms[0]]).union(ancestor_lookup[terms[0]])
+def propagate_terms(df, obo_file):
+    """
+    Propagate the annotations of each protein to all ancestor terms in the ontology, see propagate_matrix.
+
+    :param df: cleaned annotations with columns DB_Object_ID, GO_ID and Aspect
+    :param obo_file: OBO file of the ontology
+    :return: DataFrame with columns EntryID, term (list of propagated terms) and aspect (BPO, CCO or MFO)
+    """
+    rows, terms, propagated = propagate_matrix(df, obo_file)
+    if len(rows) == 0:
+        return pd.DataFrame(columns=['EntryID', 'term', 'aspect'])
 
-            gene_terms -= obsolete_remove
-            if len(gene_terms) >= 1:  # perhaps gene only had obsolete terms
-                propagated_terms.append({'EntryID': gene, 'term': list(gene_terms), 'aspect':subontology})
+    term_array = terms.astype(object)
+    gene_terms = np.split(term_array[propagated.indices], propagated.indptr[1:-1])
 
-    return pd.DataFrame(propagated_terms)
+    return pd.DataFrame({'EntryID': rows.EntryID.values,
+                         'term': [list(t) for t in gene_terms],
+                         'aspect': rows.aspect.values})
 
 
 def get_all_taxonomies(annotations_df):
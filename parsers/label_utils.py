@@ -0,0 +1,158 @@
+import os
+from contextlib import ExitStack
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from parsers.goa_utils import SUBONTOLOGIES
+from parsers.stage_cache import atomic_directory
+
+
+def labels_to_frame(rows, terms, propagated):
+    """ Long format of propagated labels, with one row per (protein, term) as in terms.tsv.
+        Built directly from the sparse matrix returned by goa_utils.propagate_matrix """
+    counts = np.diff(propagated.indptr)
+    return pd.DataFrame({'EntryID': np.repeat(rows.EntryID.values, counts),
+                         'term': terms[propagated.indices],
+                         'aspect': np.repeat(rows.aspect.values, counts)})
+
+
+def label_order(rows):
+    """ Order of the rows of propagated labels by aspect and EntryID, as returned by goa_utils.propagate_matrix.
+        Used to sort labels combined from several parts """
+    aspect_order = rows.aspect.map({subontology: i for i, subontology in enumerate(SUBONTOLOGIES)}).values
+    return np.lexsort((rows.EntryID.values, aspect_order))
+
+
+def save_propagated(rows, terms, propagated, location):
+    """ Save the output of goa_utils.propagate_matrix to a directory """
+    rows.to_parquet(os.path.join(location, 'rows.parquet'), index=False)
+    np.save(os.path.join(location, 'terms.npy'), np.asarray(terms).astype(str))
+    sp.save_npz(os.path.join(location, 'propagated.npz'), propagated)
+
+
+def load_propagated(location):
+    """ Load the (rows, terms, propagated) labels saved by save_propagated """
+    rows = pd.read_parquet(os.path.join(location, 'rows.parquet'))
+    terms = np.load(os.path.join(location, 'terms.npy'))
+    propagated = sp.load_npz(os.path.join(location, 'propagated.npz')).tocsr()
+    return rows, terms, propagated
+
+
+def save_label_matrices(rows, terms, propagated, location):
+    """
+    Save propagated labels as one sparse protein x term CSR matrix per aspect. Each aspect is saved in
+    <location>/<aspect>/ as .npy files that can be memory-mapped: indptr, indices and data of the matrix,
+    entries (EntryID of each row) and terms (GO term of each column). Columns are only the terms that
+    label at least one protein in that aspect, in ontology order.
+
+    :param rows: DataFrame with EntryID and aspect of each row of propagated, as returned by goa_utils.propagate_matrix
+    :param terms: array of term IDs of the columns of propagated
+    :param propagated: sparse boolean CSR matrix of propagated labels
+    :param location: directory to save the matrices to. Will be created if does not exist.
+    """
+    os.makedirs(location, exist_ok=True)
+    for subontology in SUBONTOLOGIES:
+        aspect_rows = np.flatnonzero(rows.aspect.values == subontology)
+        matrix = propagated[aspect_rows]
+        # keep only the columns used in this aspect
+        columns = np.unique(matrix.indices)
+        matrix = matrix[:, columns].tocsr()
+        matrix.sort_indices()
+        index_dtype = np.int32 if matrix.nnz < np.iinfo(np.int32).max else np.int64
+
+        arrays = {'indptr': matrix.indptr.astype(index_dtype),
+                  'indices': matrix.indices.astype(index_dtype),
+                  'data': np.ones(matrix.nnz, dtype=bool),
+                  'entries': rows.EntryID.values[aspect_rows].astype(str),
+                  'terms': np.asarray(terms)[columns].astype(str)}
+        with atomic_directory(os.path.join(location, subontology)) as tmp_location:
+            for name, array in arrays.items():
+                np.save(os.path.join(tmp_location, f'{name}.npy'), array)
+
+
+def merge_label_matrices(parts, terms, location):
+    """
+    Save labels saved in parts by save_propagated as one label matrix per aspect, the same as save_label_matrices
+    does with the labels of all the parts sorted by label_order. Parts are read one at a time and their labels are
+    written straight to memory-mapped matrix files, so only the rows of the parts are kept in memory.
+
+    :param parts: directories saved by save_propagated, with the labels of different proteins
+    :param terms: array of term IDs of the columns of all parts
+    :param location: directory to save the matrices to. Will be created if does not exist.
+    """
+    os.makedirs(location, exist_ok=True)
+    terms = np.asarray(terms)
+    # first pass: rows, number of labels of each row and columns used in each aspect
+    part_entries = {subontology: [np.zeros(0, dtype=str)] for subontology in SUBONTOLOGIES}
+    part_counts = {subontology: [np.zeros(0, dtype=np.int64)] for subontology in SUBONTOLOGIES}
+    used = {subontology: np.zeros(len(terms), dtype=bool) for subontology in SUBONTOLOGIES}
+    for part in parts:
+        rows, _, propagated = load_propagated(part)
+        counts = np.diff(propagated.indptr)
+        for subontology in SUBONTOLOGIES:
+            aspect_rows = np.flatnonzero(rows.aspect.values == subontology)
+            part_entries[subontology].append(rows.EntryID.values[aspect_rows].astype(str))
+            part_counts[subontology].append(counts[aspect_rows])
+            used[subontology][propagated[aspect_rows].indices] = True
+
+    # rows are sorted by EntryID, and each part has its own proteins. The matrices of all aspects are
+    # written at once and renamed when they are complete
+    with ExitStack() as stack:
+        aspects = {}
+        for subontology in SUBONTOLOGIES:
+            entries = np.concatenate(part_entries[subontology])
+            order = np.argsort(entries, kind='stable')
+            rank = np.empty(len(order), dtype=np.int64)
+            rank[order] = np.arange(len(order))
+            indptr = np.append(0, np.cumsum(np.concatenate(part_counts[subontology])[order])).astype(np.int64)
+            columns = np.flatnonzero(used[subontology])
+            column_map = np.full(len(terms), -1, dtype=np.int64)
+            column_map[columns] = np.arange(len(columns))
+            index_dtype = np.int32 if indptr[-1] < np.iinfo(np.int32).max else np.int64
+
+            tmp_location = stack.enter_context(atomic_directory(os.path.join(location, subontology)))
+            for name, array in [('indptr', indptr.astype(index_dtype)), ('entries', entries[order]),
+                                ('terms', terms[columns].astype(str))]:
+                np.save(os.path.join(tmp_location, f'{name}.npy'), array)
+            indices = np.lib.format.open_memmap(os.path.join(tmp_location, 'indices.npy'), mode='w+',
+                                                dtype=index_dtype, shape=(indptr[-1],))
+            data = np.lib.format.open_memmap(os.path.join(tmp_location, 'data.npy'), mode='w+', dtype=bool,
+                                             shape=(indptr[-1],))
+            data[:] = True
+            aspects[subontology] = (rank, indptr, column_map, indices, data)
+
+        # second pass: labels of each part are copied to the rows they are sorted to
+        offsets = {subontology: 0 for subontology in SUBONTOLOGIES}
+        for part in parts:
+            rows, _, propagated = load_propagated(part)
+            for subontology in SUBONTOLOGIES:
+                rank, indptr, column_map, indices, _ = aspects[subontology]
+                matrix = propagated[np.flatnonzero(rows.aspect.values == subontology)]
+                matrix.sort_indices()
+                part_rank = rank[offsets[subontology]:offsets[subontology] + matrix.shape[0]]
+                offsets[subontology] += matrix.shape[0]
+                # position of each label in indices: start of its row in the merged matrix plus its place in the row
+                positions = (np.repeat(indptr[part_rank] - matrix.indptr[:-1], np.diff(matrix.indptr))
+                             + np.arange(matrix.nnz))
+                indices[positions] = column_map[matrix.indices]
+
+        for _, _, _, indices, data in aspects.values():
+            indices.flush()
+            data.flush()
+
+
+def load_label_matrix(location, subontology):
+    """
+    Load the label matrix of one aspect saved by save_label_matrices. Arrays are memory-mapped, not copied.
+
+    :param location: directory of the saved matrices
+    :param subontology: BPO, CCO or MFO
+    :return: (matrix, entries, terms): sparse boolean CSR matrix of shape (len(entries), len(terms)),
+             array of EntryID of the rows and array of GO terms of the columns
+    """
+    def load(name):
+        return np.load(os.path.join(location, subontology, f'{name}.npy'), mmap_mode='r')
+
+    entries, terms = load('entries'), load('terms')
+    matrix = sp.csr_matrix((load('data'), load('indices'), load('indptr')), shape=(len(entries), len(terms)))
+    return matrix, entries, terms
@@ -0,0 +1,136 @@
+import os
+from collections import namedtuple
+import numpy as np
+import scipy.sparse as sp
+import networkx as nx
+import obonet
+from parsers.run_report import count_cache
+from parsers.stage_cache import atomic_directory, file_hash, input_fingerprint
+
+
+def load_go_graph(obo_file):
+    """ Read an OBO file into a networkx graph with only "is_a" and "part_of" edges.
+        Edges point from child term to parent term """
+    obonet_graph = obonet.read_obo(obo_file)
+    # keep only "is_a" and "part_of" edges
+    remove_edges = [(i, j, k) for i, j, k in obonet_graph.edges if not(k=="is_a" or k=="part_of")]
+    obonet_graph.remove_edges_from(remove_edges)
+    return obonet_graph
+
+
+def ancestor_closure(obonet_graph):
+    """
+    Transitive closure of the ontology graph as a sparse boolean term x term matrix.
+
+    Row i of the matrix marks term i and all of its ancestors, so multiplying a (protein x term)
+    incidence matrix by the closure propagates every annotation to the ontology roots.
+
+    :param obonet_graph: ontology graph with edges from child to parent, as returned by load_go_graph
+    :return: (list of term IDs in matrix order, CSR matrix of shape (n_terms, n_terms))
+    """
+    terms = list(obonet_graph.nodes)
+    term_index = {term: i for i, term in enumerate(terms)}
+
+    # visit parents before their children so each term only unions the closures of its direct parents
+    ancestors = [None] * len(terms)
+    for term in reversed(list(nx.topological_sort(obonet_graph))):
+        i = term_index[term]
+        term_ancestors = {i}
+        for parent in obonet_graph.successors(term):
+            term_ancestors |= ancestors[term_index[parent]]
+        ancestors[i] = term_ancestors
+
+    lengths = np.fromiter((len(a) for a in ancestors), dtype=np.int64, count=len(terms))
+    indptr = np.concatenate([[0], np.cumsum(lengths)])
+    indices = np.fromiter((j for a in ancestors for j in sorted(a)), dtype=np.int32, count=indptr[-1])
+    closure = sp.csr_matrix((np.ones(len(indices), dtype=bool), indices, indptr), shape=(len(terms), len(terms)))
+    return terms, closure
+
+
+# GAF aspect letter of each GO namespace
+NAMESPACE_ASPECTS = {'biological_process': 'P', 'cellular_component': 'C', 'molecular_function': 'F'}
+
+# bump when the layout of the compiled ontology files changes
+COMPILED_VERSION = 1
+
+# Compiled ontology. terms is an array of term IDs, aspect the GAF aspect letter of each term,
+# parents a CSR term x term matrix of the is_a/part_of edges (row = child) and closure the ancestor closure
+Ontology = namedtuple('Ontology', ['terms', 'aspect', 'parents', 'closure'])
+
+
+def compiled_location(obo_file, cache_dir=None):
+    """ Directory of the compiled ontology for the current contents of obo_file. It is stored next to the OBO file.
+        With a cache_dir, the hash of the contents remembered by stage_cache.input_fingerprint is used, so an
+        unchanged file is not read again """
+    digest = input_fingerprint(obo_file, cache_dir) if cache_dir is not None else file_hash(obo_file)
+    return f'{obo_file}.{digest[:16]}.v{COMPILED_VERSION}.compiled'
+
+
+def compile_ontology(obo_file):
+    """ Parse an OBO file and compile it into integer term IDs with CSR arrays of edges and ancestor closure """
+    obonet_graph = load_go_graph(obo_file)
+    terms, closure = ancestor_closure(obonet_graph)
+    term_index = {term: i for i, term in enumerate(terms)}
+
+    aspect = np.array([NAMESPACE_ASPECTS.get(obonet_graph.nodes[t].get('namespace'), '') for t in terms], dtype='U1')
+    edges = np.array([(term_index[child], term_index[parent]) for child, parent in obonet_graph.edges()],
+                     dtype=np.int32).reshape(-1, 2)
+    parents = sp.csr_matrix((np.ones(len(edges), dtype=bool), (edges[:, 0], edges[:, 1])),
+                            shape=(len(terms), len(terms)))
+    parents.sum_duplicates()
+    return Ontology(np.array(terms), aspect, parents, closure)
+
+
+def save_ontology(ontology, location):
+    """ Save a compiled ontology as a directory of .npy files, written with stage_cache.atomic_directory so
+        a partial write is never loaded. If another process saved the same ontology first, its copy is kept """
+    with atomic_directory(location, replace=False) as tmp_location:
+        np.save(os.path.join(tmp_location, 'terms.npy'), ontology.terms)
+        np.save(os.path.join(tmp_location, 'aspect.npy'), ontology.aspect)
+        for name in ['parents', 'closure']:
+            matrix = getattr(ontology, name)
+            np.save(os.path.join(tmp_location, f'{name}_indptr.npy'), matrix.indptr)
+            np.save(os.path.join(tmp_location, f'{name}_indices.npy'), matrix.indices)
+
+
+def read_ontology(location):
+    """ Memory-map a compiled ontology saved by save_ontology """
+    def load(name):
+        return np.load(os.path.join(location, f'{name}.npy'), mmap_mode='r')
+
+    terms = load('terms')
+    matrices = []
+    for name in ['parents', 'closure']:
+        indices, indptr = load(f'{name}_indices'), load(f'{name}_indptr')
+        matrices.append(sp.csr_matrix((np.ones(len(indices), dtype=bool), indices, indptr),
+                                      shape=(len(terms), len(terms))))
+    return Ontology(terms, load('aspect'), *matrices)
+
+
+def load_ontology(obo_file, use_cache=True, cache_dir=None):
+    """
+    Load the compiled form of an ontology. The first time an OBO file is used it is parsed and compiled, and the
+    result is saved next to it in a directory named after a hash of the file contents. Later calls memory-map the
+    compiled files instead of parsing the OBO file again. Editing the OBO file changes its hash, so a stale
+    compiled ontology is never used.
+
+    :param obo_file: OBO file of the ontology
+    :param use_cache: if False, always parse the OBO file and don't save the compiled ontology
+    :param cache_dir: directory of cached stage outputs, whose file_hashes.json remembers the hash of the OBO file
+                      (see compiled_location)
+    :return: Ontology namedtuple
+    """
+    if not use_cache:
+        return compile_ontology(obo_file)
+
+    location = compiled_location(obo_file, cache_dir)
+    count_cache('ontology', os.path.isdir(location))
+    if os.path.isdir(location):
+        return read_ontology(location)
+
+    ontology = compile_ontology(obo_file)
+    try:
+        save_ontology(ontology, location)
+    except OSError as e:
+        print(f'Could not save compiled ontology to {location}: {e}')
+    return ontology
@@ -0,0 +1,129 @@
+import os
+import shutil
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from tqdm import tqdm
+from parsers.obo_utils import Ontology, load_ontology
+from parsers.goa_utils import ANNOTATION_COLUMNS, CHUNK_SIZE, clean_annotations, propagate_matrix, get_all_taxonomies
+from parsers.label_utils import labels_to_frame, save_propagated, merge_label_matrices
+
+
+# rough peak memory used per filtered annotation while a partition is cleaned and propagated, in bytes
+ROW_MEMORY = 2000
+# rough peak memory used per byte of GAF text while a block is parsed and filtered
+TEXT_MEMORY = 10
+# smallest block of GAF text parsed at once, smaller blocks only add overhead
+MIN_CHUNK_SIZE = 64 * 1024
+# largest batch of annotations read at once when they are partitioned
+MAX_BATCH_SIZE = 1000000
+
+
+def parse_memory(size):
+    """ Parse a memory size like '512M', '16G' or '1000000' (bytes) into a number of bytes """
+    units = {'K': 1024, 'M': 1024**2, 'G': 1024**3, 'T': 1024**4}
+    size = size.strip().upper().rstrip('B')
+    if size and size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+
+def filter_chunk_size(max_memory, workers=1):
+    """ Size of the blocks of GAF text parsed at once (see goa_utils.filter_evidence) so that filtering
+        with workers processes stays within max_memory bytes, between MIN_CHUNK_SIZE and goa_utils.CHUNK_SIZE """
+    return int(min(CHUNK_SIZE, max(MIN_CHUNK_SIZE, max_memory // (TEXT_MEMORY * max(1, workers)))))
+
+
+def partition_batch_size(max_memory):
+    """ Number of annotations read at once by partition_annotations to stay within max_memory bytes """
+    return int(min(MAX_BATCH_SIZE, max(1, max_memory // ROW_MEMORY)))
+
+
+def count_partitions(filtered_file, max_memory):
+    """ Number of partitions needed to process the annotations of a Parquet evidence cache within max_memory bytes """
+    num_rows = pq.ParquetFile(filtered_file).metadata.num_rows
+    return max(1, int(np.ceil(num_rows * ROW_MEMORY / max_memory)))
+
+
+def partition_annotations(filtered_file, location, n_partitions, batch_size=MAX_BATCH_SIZE):
+    """
+    Split the annotations of a Parquet evidence cache into n_partitions Parquet files by a hash of DB_Object_ID,
+    so all the annotations of a protein are in the same partition. The cache is read in batches.
+
+    :param batch_size: number of annotations read at once, see partition_batch_size
+    :return: list of partition files
+    """
+    os.makedirs(location, exist_ok=True)
+    partition_files = [os.path.join(location, f'part-{i:05d}.parquet') for i in range(n_partitions)]
+    writers = [None] * n_partitions
+    for batch in pq.ParquetFile(filtered_file).iter_batches(batch_size=batch_size, columns=ANNOTATION_COLUMNS):
+        table = pa.Table.from_batches([batch])
+        proteins = batch.column('DB_Object_ID').to_numpy(zero_copy_only=False)
+        partition = pd.util.hash_array(proteins.astype(object)) % n_partitions
+        for i in np.unique(partition):
+            if writers[i] is None:
+                writers[i] = pq.ParquetWriter(partition_files[i], table.schema)
+            writers[i].write_table(table.filter(pa.array(partition == i)))
+    for writer in writers:
+        if writer is not None:
+            writer.close()
+    return [f for f, writer in zip(partition_files, writers) if writer is not None]
+
+
+def process_partitions(filtered_file, obo_file, location, max_memory, labels='tsv'):
+    """
+    Clean and propagate annotations one partition at a time, so memory use stays bounded at any input size.
+    The annotations are partitioned on disk by protein, then each partition is deduplicated, stripped of negative
+    labels, propagated and appended to the outputs before the next one is loaded.
+
+    Outputs have the same rows as when all annotations are processed at once, grouped by partition.
+
+    :param filtered_file: Parquet evidence cache saved by filter_evidence
+    :param obo_file: OBO file of the ontology, or an already loaded Ontology
+    :param location: directory to save outputs to: terms.tsv (if labels is 'tsv' or 'both'), labels/ (if
+                     labels is 'matrix' or 'both') and taxonomy.tsv
+    :param max_memory: approximate memory budget in bytes, used to choose the number of partitions and the
+                       number of annotations read at once while partitioning. The labels of the partitions
+                       are merged into the label matrices on disk (see label_utils.merge_label_matrices)
+    :param labels: 'tsv', 'matrix' or 'both', see save_label_matrices
+    """
+    n_partitions = count_partitions(filtered_file, max_memory)
+    print(f'Processing annotations in {n_partitions} partitions')
+    partition_location = os.path.join(location, 'partitions')
+    partition_files = partition_annotations(filtered_file, partition_location, n_partitions,
+                                            batch_size=partition_batch_size(max_memory))
+
+    ontology = obo_file if isinstance(obo_file, Ontology) else load_ontology(obo_file)
+    matrix_parts = []
+    with open(os.path.join(location, 'taxonomy.tsv'), 'w', newline='') as taxonomy_handle:
+        terms_handle = open(os.path.join(location, 'terms.tsv'), 'w', newline='') if labels != 'matrix' else None
+        # headers are written even if there are no annotations, as when they are processed at once
+        if terms_handle is not None:
+            pd.DataFrame(columns=['EntryID', 'term', 'aspect']).to_csv(terms_handle, index=False, sep='\t')
+        pd.DataFrame(columns=['EntryID', 'taxonomyID']).to_csv(taxonomy_handle, index=False, sep='\t')
+        for i, partition_file in enumerate(tqdm(partition_files)):
+            annotations_df = clean_annotations(pd.read_parquet(partition_file))
+            rows, terms, propagated = propagate_matrix(annotations_df, ontology)
+
+            if terms_handle is not None:
+                labels_to_frame(rows, terms, propagated).to_csv(terms_handle, header=False, index=False, sep='\t')
+            if labels != 'tsv':
+                # labels of each partition are kept on disk and merged into the label matrices at the end
+                matrix_location = os.path.join(partition_location, f'labels-{i:05d}')
+                os.makedirs(matrix_location)
+                save_propagated(rows, terms, propagated, matrix_location)
+                matrix_parts.append(matrix_location)
+
+            # In some cases, only obsolete terms are annotated for some protein
+            # so we get rid of any proteins without terms
+            annotations_df = annotations_df[annotations_df.DB_Object_ID.isin(rows.EntryID)]
+            get_all_taxonomies(annotations_df).to_csv(taxonomy_handle, header=False, index=False, sep='\t')
+            os.remove(partition_file)
+        if terms_handle is not None:
+            terms_handle.close()
+
+    if labels != 'tsv':
+        # same row order as propagate_matrix on all annotations: by aspect and EntryID
+        merge_label_matrices(matrix_parts, ontology.terms, os.path.join(location, 'labels'))
+    shutil.rmtree(partition_location, ignore_errors=True)
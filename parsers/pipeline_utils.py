@@ -0,0 +1,233 @@
+import os
+import shutil
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from parsers.goa_utils import CHUNK_SIZE, make_scope, filter_evidence, filter_profiles, load_annotations, clean_annotations, \
+    propagate_matrix, get_all_taxonomies
+from parsers.label_utils import labels_to_frame, label_order, save_label_matrices, save_propagated, load_propagated
+from parsers.stage_cache import run_stage, stage_key
+from parsers.partition_utils import process_partitions
+from parsers.obo_utils import compiled_location, load_ontology
+from parsers.delta_utils import update_propagated
+from parsers.snapshot_utils import save_snapshots
+from parsers.run_report import report_rows
+
+
+# files and directories that can be published from the outputs of label_stages, and the release.json
+# saved with them by process_goa.py
+LABEL_OUTPUTS = ['terms.tsv', 'labels', 'taxonomy.tsv', 'changelog.tsv', 'release.json']
+
+
+def scope_inputs(taxa=None, proteins_file=None):
+    """ Parameters and input files that a Scope of taxa and/or proteins (see goa_utils.make_scope) adds to
+        the key of a filtering stage. Nothing is added without a scope, so keys are the same as before """
+    params = {'taxa': sorted(map(int, taxa))} if taxa is not None else {}
+    files = [proteins_file] if proteins_file is not None else []
+    return params, files
+
+
+def filter_stage(cache_dir, goa_file, highthr=False, workers=1, taxa=None, proteins_file=None, chunk_size=CHUNK_SIZE):
+    """
+    Filter a GAF file by evidence code (see goa_utils.filter_evidence) as a cached stage.
+    Annotations out of the taxa and proteins (one accession per line of proteins_file) given are never saved.
+    chunk_size (see partition_utils.filter_chunk_size) only changes memory use, not the filtered annotations.
+
+    :return: (Parquet evidence cache file, key of the stage)
+    """
+    scope_params, scope_files = scope_inputs(taxa, proteins_file)
+    return run_stage(
+        cache_dir, 'filter',
+        build=lambda location: filter_evidence(goa_file, os.path.join(location, 'evidence.parquet'),
+                                               highthr=highthr, chunk_size=chunk_size, workers=workers, load=False,
+                                               scope=make_scope(taxa, proteins_file), index_dir=cache_dir),
+        load=lambda location: os.path.join(location, 'evidence.parquet'),
+        params={'highthr': highthr, **scope_params}, files=[goa_file] + scope_files)
+
+
+def profiles_filter_stage(cache_dir, goa_file, profiles, workers=1, taxa=None, proteins_file=None,
+                          chunk_size=CHUNK_SIZE):
+    """
+    Filter a GAF file with several evidence profiles in a single read (see goa_utils.filter_profiles)
+    as a cached stage. Annotations out of the taxa and proteins given are never saved and chunk_size only
+    changes memory use, see filter_stage.
+
+    :param profiles: dict of profile name to goa_utils.EvidenceProfile
+    :return: dict of profile name to (Parquet evidence cache file, key of the annotations of the profile).
+             The key of a profile only depends on the GAF file, the scope and the profile definition, so the
+             later stages of a profile are reused when other profiles are added or changed
+    """
+    definitions = {name: profile._asdict() for name, profile in profiles.items()}
+    scope_params, scope_files = scope_inputs(taxa, proteins_file)
+    location, _ = run_stage(
+        cache_dir, 'filter_profiles',
+        build=lambda location: filter_profiles(goa_file, {name: os.path.join(location, f'{name}.parquet')
+                                                          for name in profiles}, profiles, chunk_size=chunk_size,
+                                               workers=workers, scope=make_scope(taxa, proteins_file),
+                                               index_dir=cache_dir),
+        load=lambda location: location,
+        params={'profiles': definitions, **scope_params}, files=[goa_file] + scope_files)
+    return {name: (os.path.join(location, f'{name}.parquet'),
+                   stage_key(cache_dir, 'filter', params={'profile': definition, **scope_params},
+                             files=[goa_file] + scope_files))
+            for name, definition in definitions.items()}
+
+
+def clean_stage(cache_dir, filtered_file, filter_key):
+    """
+    Remove duplicates and negative labels from filtered annotations (see goa_utils.clean_annotations) as a cached stage.
+
+    :return: (Parquet file of cleaned annotations, key of the stage)
+    """
+    def save_clean(location):
+        filtered_df = load_annotations(filtered_file)
+        annotations_df = clean_annotations(filtered_df)
+        annotations_df.to_parquet(os.path.join(location, 'annotations.parquet'))
+        report_rows(rows_in=len(filtered_df), rows_out=len(annotations_df))
+
+    print('Removing duplicates and negative labels')
+    return run_stage(
+        cache_dir, 'clean', build=save_clean, load=lambda location: os.path.join(location, 'annotations.parquet'),
+        depends=[filter_key])
+
+
+def snapshot_stage(cache_dir, filtered_file, filter_key, obo_file, cutoffs, labels='tsv', ontology=None):
+    """
+    Propagate the annotations made up to each cutoff date and find the proteins newly annotated between
+    cutoffs (see snapshot_utils.save_snapshots) as cached stages.
+
+    :return: directory of the snapshots
+    """
+    annotations_file, clean_key = clean_stage(cache_dir, filtered_file, filter_key)
+    print(f'Propagating annotations made up to {", ".join(map(str, cutoffs))}')
+    snapshots_location, _ = run_stage(
+        cache_dir, 'snapshots',
+        build=lambda location: save_snapshots(pd.read_parquet(annotations_file), cutoffs,
+                                              ontology if ontology is not None
+                                              else load_ontology(obo_file, cache_dir=cache_dir),
+                                              location, labels=labels),
+        load=lambda location: location,
+        params={'cutoffs': sorted(map(str, cutoffs)), 'labels': labels}, files=[obo_file], depends=[clean_key])
+    return snapshots_location
+
+
+def label_stages(cache_dir, filtered_file, filter_key, obo_file, labels='tsv', max_memory=None, ontology=None,
+                 previous=None, clean=None, keep_unlabeled_taxonomy=False):
+    """
+    Clean and propagate filtered annotations and write the output files as cached stages:
+    terms.tsv (if labels is 'tsv' or 'both'), labels/ (if labels is 'matrix' or 'both'), taxonomy.tsv and,
+    if previous is given, changelog.tsv.
+
+    :param cache_dir: directory of cached stage outputs
+    :param filtered_file: Parquet evidence cache returned by filter_stage
+    :param filter_key: key of the filter stage
+    :param obo_file: OBO file of the ontology
+    :param labels: 'tsv', 'matrix' or 'both'
+    :param max_memory: if not None, approximate memory budget in bytes. Annotations are then processed in
+                       partitions of proteins (see partition_utils.process_partitions)
+    :param ontology: already loaded Ontology of obo_file, to avoid loading it again
+    :param previous: description of a previous release (see delta_utils.load_release). If given, only the
+                     proteins whose annotations changed since that release are propagated again
+                     (see delta_utils.update_propagated) and their label changes are saved to changelog.tsv
+    :param clean: (annotations file, key) already returned by clean_stage for filtered_file, if any
+    :param keep_unlabeled_taxonomy: also list in taxonomy.tsv the proteins that have no labels (only obsolete
+                                    terms), as make_dataset.py does
+    :return: (directory of the output files, description of the release to save with delta_utils.save_release,
+             or None if max_memory is given): dict of the cleaned annotations file, the directory of the propagated
+             labels saved by label_utils.save_propagated, the key of the propagation stage and the compiled ontology
+    """
+    def get_ontology():
+        # loaded only when a stage is built. The OBO file was already hashed for the stage key
+        return ontology if ontology is not None else load_ontology(obo_file, cache_dir=cache_dir)
+
+    if max_memory is not None:
+        # Clean, propagate and save outputs one partition of proteins at a time
+        print(f'Processing annotations in partitions to use less than about {max_memory/1024**2:.0f} MB of memory')
+        outputs_location, _ = run_stage(
+            cache_dir, 'partitioned',
+            build=lambda location: process_partitions(filtered_file, get_ontology(), location, max_memory,
+                                                      labels=labels),
+            load=lambda location: location,
+            params={'labels': labels}, files=[obo_file], depends=[filter_key])
+        return outputs_location, None
+
+    # Remove any duplicates or negative labels
+    annotations_file, clean_key = clean if clean is not None else clean_stage(cache_dir, filtered_file, filter_key)
+
+    # Propagate labels to root
+    print('Propagating annotations to ontology roots and removing obsolete labels')
+    if previous is None:
+        def save_propagate(location):
+            annotations_df = pd.read_parquet(annotations_file)
+            rows, terms, propagated = propagate_matrix(annotations_df, get_ontology())
+            save_propagated(rows, terms, propagated, location)
+            report_rows(rows_in=len(annotations_df), rows_out=len(rows), labels=propagated.nnz)
+
+        propagated_location, propagate_key = run_stage(
+            cache_dir, 'propagate', build=save_propagate, load=lambda location: location,
+            files=[obo_file], depends=[clean_key])
+    else:
+        def save_delta(location):
+            annotations_df = pd.read_parquet(annotations_file)
+            rows, terms, propagated, changelog = update_propagated(previous, annotations_df, get_ontology())
+            save_propagated(rows, terms, propagated, location)
+            changelog.to_csv(os.path.join(location, 'changelog.tsv'), index=False, sep='\t')
+            report_rows(rows_in=len(annotations_df), rows_out=len(rows), labels=propagated.nnz,
+                        changed_labels=len(changelog))
+
+        print(f'Updating labels of the previous release from {previous["propagated"]}')
+        propagated_location, propagate_key = run_stage(
+            cache_dir, 'delta', build=save_delta, load=lambda location: location,
+            files=[obo_file], depends=[clean_key, previous['propagate_key']])
+
+    def save_outputs(location):
+        rows, terms, propagated = load_propagated(propagated_location)
+
+        if labels in ['tsv', 'both']:
+            # one row per (protein, term), built directly from the sparse labels
+            all_terms = labels_to_frame(rows, terms, propagated)
+            all_terms.to_csv(os.path.join(location, 'terms.tsv'), index=False, sep='\t')
+
+        if labels in ['matrix', 'both']:
+            save_label_matrices(rows, terms, propagated, os.path.join(location, 'labels'))
+
+        if previous is not None:
+            shutil.copyfile(os.path.join(propagated_location, 'changelog.tsv'), os.path.join(location, 'changelog.tsv'))
+
+        # In some cases, only obsolete terms are annotated for some protein
+        # so we get rid of any proteins without terms
+        annotations_df = pd.read_parquet(annotations_file, columns=['DB_Object_ID', 'species'])
+        if not keep_unlabeled_taxonomy:
+            annotations_df = annotations_df[annotations_df.DB_Object_ID.isin(rows.EntryID)]
+        # Find taxonomies
+        taxdf = get_all_taxonomies(annotations_df)
+        taxdf.to_csv(os.path.join(location, 'taxonomy.tsv'), index=False, sep='\t')
+        report_rows(rows_in=len(rows), rows_out=propagated.nnz, proteins=len(taxdf))
+
+    # save labels and taxonomies to file
+    params = {'labels': labels, **({'keep_unlabeled_taxonomy': True} if keep_unlabeled_taxonomy else {})}
+    outputs_location, _ = run_stage(cache_dir, 'outputs', build=save_outputs, load=lambda location: location,
+                                    params=params, depends=[clean_key, propagate_key])
+    release = {'annotations': os.path.abspath(annotations_file), 'propagated': os.path.abspath(propagated_location),
+               'propagate_key': propagate_key, 'ontology': os.path.abspath(compiled_location(obo_file, cache_dir))}
+    return outputs_location, release
+
+
+def merge_propagated(propagated_locations):
+    """
+    Combine propagated labels saved by label_utils.save_propagated for several datasets (eg. species) that were
+    propagated with the same ontology. Rows are sorted by aspect and EntryID as in goa_utils.propagate_matrix, and
+    a protein that has labels of the same aspect in several datasets keeps those of the first one.
+
+    :return: (rows, terms, propagated) as returned by goa_utils.propagate_matrix
+    """
+    parts = [load_propagated(location) for location in propagated_locations]
+    terms = parts[0][1]
+    assert all(np.array_equal(part_terms, terms) for _, part_terms, _ in parts), \
+        'Labels were propagated with different ontologies'
+
+    rows = pd.concat([part_rows for part_rows, _, _ in parts], ignore_index=True)
+    propagated = sp.vstack([part for _, _, part in parts]).tocsr()
+    keep = np.flatnonzero(~rows.duplicated().values)
+    order = keep[label_order(rows.iloc[keep])]
+    return rows.iloc[order].reset_index(drop=True), terms, propagated[order]
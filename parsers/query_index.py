@@ -0,0 +1,204 @@
+import os
+import json
+from collections import namedtuple
+from functools import reduce
+import numpy as np
+import scipy.sparse as sp
+from parsers.goa_utils import SUBONTOLOGIES
+from parsers.stage_cache import atomic_directory
+
+
+# bump when the layout of the index files changes
+INDEX_VERSION = 1
+
+# Sorted integer postings: the ids of key i are indices[indptr[i]:indptr[i+1]], as the arrays of a CSR matrix
+Postings = namedtuple('Postings', ['indptr', 'indices'])
+
+# Query index of propagated labels. entries are the sorted accessions of the proteins and terms the GO terms in
+# ontology order, sorted_terms the terms sorted and term_order the position of each of them in terms. Each row of the labels is an (aspect, protein) pair with its entry in
+# row_entry and its aspect (index in SUBONTOLOGIES) in row_aspect. forward are the terms of each row, inverted
+# the rows of each term and entry_rows the rows of each entry. ancestors and descendants of each term (itself
+# included) come from the ancestor closure of the ontology
+QueryIndex = namedtuple('QueryIndex', ['entries', 'terms', 'sorted_terms', 'term_order', 'row_entry', 'row_aspect', 'forward',
+                                       'inverted', 'entry_rows', 'ancestors', 'descendants'])
+
+
+def _to_postings(matrix):
+    """ Postings of the rows of a sparse matrix, with the smallest integer types that fit """
+    matrix = sp.csr_matrix(matrix)
+    matrix.sort_indices()
+    index_dtype = np.int32 if max(matrix.shape) < np.iinfo(np.int32).max else np.int64
+    return Postings(matrix.indptr.astype(np.int64), matrix.indices.astype(index_dtype))
+
+
+def build_query_index(rows, terms, propagated, ontology, location):
+    """
+    Build an index of propagated labels (see goa_utils.propagate_matrix) that answers which terms a protein
+    has and which proteins have a term without loading the labels. All arrays are saved as .npy files in
+    location and are memory-mapped by load_query_index.
+
+    :param rows: DataFrame with EntryID and aspect of each row of propagated
+    :param terms: array of term IDs of the columns of propagated
+    :param propagated: sparse boolean CSR matrix of propagated labels
+    :param ontology: compiled Ontology the labels were propagated with, for ancestors and descendants
+    :param location: directory to save the index to
+    :return: index, as returned by load_query_index
+    """
+    terms = np.asarray(terms).astype(str)
+    assert np.array_equal(terms, np.asarray(ontology.terms).astype(str)), \
+        'Labels were propagated with a different ontology'
+    entries, row_entry = np.unique(rows.EntryID.values.astype(str), return_inverse=True)
+    row_aspect = rows.aspect.map({subontology: i for i, subontology in enumerate(SUBONTOLOGIES)}).values
+    propagated = sp.csr_matrix(propagated)
+    entry_matrix = sp.csr_matrix((np.ones(len(rows), dtype=bool), (row_entry, np.arange(len(rows)))),
+                                 shape=(len(entries), len(rows)))
+
+    term_order = np.argsort(terms, kind='stable')
+    arrays = {'entries': entries, 'terms': terms, 'sorted_terms': terms[term_order], 'term_order': term_order,
+              'row_entry': row_entry.astype(np.int32), 'row_aspect': row_aspect.astype(np.int8)}
+    for name, matrix in [('forward', propagated), ('inverted', propagated.T), ('entry_rows', entry_matrix),
+                         ('ancestors', ontology.closure), ('descendants', ontology.closure.T)]:
+        postings = _to_postings(matrix)
+        arrays[f'{name}_indptr'], arrays[f'{name}_indices'] = postings.indptr, postings.indices
+
+    with atomic_directory(location) as tmp_location:
+        for name, array in arrays.items():
+            np.save(os.path.join(tmp_location, f'{name}.npy'), array)
+        with open(os.path.join(tmp_location, 'index.json'), 'w') as f:
+            json.dump({'version': INDEX_VERSION, 'entries': len(entries), 'terms': len(terms), 'rows': len(rows),
+                       'labels': int(propagated.nnz)}, f, indent=1)
+
+    print(f'Indexed {propagated.nnz} labels of {len(entries)} proteins and {len(terms)} terms in {location}')
+    return load_query_index(location)
+
+
+def load_query_index(location):
+    """ Memory-map an index saved by build_query_index. Only the pages used by queries are read from disk """
+    with open(os.path.join(location, 'index.json')) as f:
+        version = json.load(f)['version']
+    assert version == INDEX_VERSION, f'Index {location} has version {version}, build it again'
+
+    def load(name):
+        return np.load(os.path.join(location, f'{name}.npy'), mmap_mode='r')
+
+    postings = {name: Postings(load(f'{name}_indptr'), load(f'{name}_indices'))
+                for name in ['forward', 'inverted', 'entry_rows', 'ancestors', 'descendants']}
+    return QueryIndex(load('entries'), load('terms'), load('sorted_terms'), load('term_order'), load('row_entry'),
+                      load('row_aspect'), **postings)
+
+
+def lookup(postings, ids):
+    """
+    Postings of a batch of ids, concatenated.
+
+    :param postings: Postings
+    :param ids: ids to look up, -1 for unknown ids, which have no postings
+    :return: (items, positions) where positions is the position in ids of the id of each item
+    """
+    ids = np.asarray(ids, dtype=np.int64)
+    positions = np.flatnonzero(ids >= 0)
+    starts = np.asarray(postings.indptr[ids[positions]])
+    counts = np.asarray(postings.indptr[ids[positions] + 1]) - starts
+    # position of every item in indices, without a loop over the ids
+    offsets = np.repeat(starts - np.concatenate([[0], np.cumsum(counts)[:-1]]), counts)
+    items = np.asarray(postings.indices[offsets + np.arange(counts.sum())], dtype=np.int64)
+    return items, np.repeat(positions, counts)
+
+
+def entry_ids(index, proteins):
+    """ Position of each accession in index.entries, or -1 if the protein has no labels """
+    proteins = np.asarray(proteins).astype(str)
+    if len(index.entries) == 0:
+        return np.full(len(proteins), -1, dtype=np.int64)
+    positions = np.minimum(np.searchsorted(index.entries, proteins), len(index.entries) - 1)
+    return np.where(np.asarray(index.entries[positions]) == proteins, positions, -1)
+
+
+def term_ids(index, terms):
+    """ Position of each GO term in index.terms, or -1 if the term is not in the ontology """
+    terms = np.asarray(terms).astype(str)
+    positions = np.minimum(np.searchsorted(index.sorted_terms, terms), len(index.sorted_terms) - 1)
+    return np.where(np.asarray(index.sorted_terms[positions]) == terms, np.asarray(index.term_order[positions]), -1)
+
+
+def _aspect_code(aspect):
+    assert aspect is None or aspect in SUBONTOLOGIES, f'Unknown aspect {aspect}, use one of {", ".join(SUBONTOLOGIES)}'
+    return SUBONTOLOGIES.index(aspect) if aspect is not None else None
+
+
+def protein_terms(index, proteins, aspect=None, leaves=False):
+    """
+    Propagated terms of a batch of proteins.
+
+    :param index: QueryIndex
+    :param proteins: accessions of the proteins
+    :param aspect: BPO, CCO or MFO to only return terms of that aspect, or None for all aspects
+    :param leaves: only return the most specific terms of each protein, ie. the terms that are not an ancestor
+                   of another term of the protein. Ancestors are expanded through the ontology closure
+    :return: dict of accession to sorted list of terms. Proteins without labels have an empty list
+    """
+    aspect_code = _aspect_code(aspect)
+    ids = entry_ids(index, proteins)
+    rows, _ = lookup(index.entry_rows, ids)
+    if aspect_code is not None:
+        rows = rows[np.asarray(index.row_aspect[rows]) == aspect_code]
+    found_terms, positions = lookup(index.forward, rows)
+    found_entries = np.asarray(index.row_entry[rows[positions]], dtype=np.int64)
+
+    if leaves and len(found_terms):
+        # a term is not a leaf if it is a proper ancestor of another term of the same protein
+        ancestors, owners = lookup(index.ancestors, found_terms)
+        proper = ancestors != found_terms[owners]
+        n_terms = len(index.terms)
+        not_leaves = found_entries[owners[proper]] * n_terms + ancestors[proper]
+        keep = ~np.isin(found_entries * n_terms + found_terms, not_leaves)
+        found_terms, found_entries = found_terms[keep], found_entries[keep]
+
+    entry_terms = {}
+    for entry, term in zip(found_entries.tolist(), index.terms[found_terms].tolist()):
+        entry_terms.setdefault(entry, []).append(term)
+    return {protein: sorted(entry_terms.get(entry, [])) for protein, entry in zip(proteins, ids.tolist())}
+
+
+def term_proteins(index, terms, aspect=None, how='any'):
+    """
+    Proteins labeled with a set of terms. Labels are propagated, so the proteins annotated with any
+    descendant of a term are included.
+
+    :param index: QueryIndex
+    :param terms: GO terms. Terms that are not in the ontology have no proteins
+    :param aspect: BPO, CCO or MFO to only count labels of that aspect, or None for all aspects
+    :param how: 'any' for the proteins with at least one of the terms (union of postings),
+                'all' for the proteins with every term (intersection of postings, smallest first)
+    :return: sorted array of accessions
+    """
+    assert how in ['any', 'all'], f'Unknown query {how}, use any or all'
+    aspect_code = _aspect_code(aspect)
+    ids = term_ids(index, terms)
+    if how == 'all' and (len(ids) == 0 or (ids < 0).any()):
+        return np.zeros(0, dtype=index.entries.dtype)
+
+    rows, positions = lookup(index.inverted, ids)
+    if aspect_code is not None:
+        keep = np.asarray(index.row_aspect[rows]) == aspect_code
+        rows, positions = rows[keep], positions[keep]
+    row_entries = np.asarray(index.row_entry[rows], dtype=np.int64)
+    if how == 'any':
+        entries = np.unique(row_entries)
+    else:
+        # the same protein can have a term in several rows (aspects), so each term's entries are made unique
+        per_term = sorted((np.unique(row_entries[positions == i]) for i in range(len(ids))), key=len)
+        entries = reduce(lambda a, b: np.intersect1d(a, b, assume_unique=True), per_term)
+    return np.asarray(index.entries[entries])
+
+
+def ancestor_terms(index, terms):
+    """ Terms and all their ancestors through is_a and part_of edges, sorted. Unknown terms are ignored """
+    found, _ = lookup(index.ancestors, term_ids(index, terms))
+    return np.sort(index.terms[np.unique(found)])
+
+
+def descendant_terms(index, terms):
+    """ Terms and all their descendants through is_a and part_of edges, sorted. Unknown terms are ignored """
+    found, _ = lookup(index.descendants, term_ids(index, terms))
+    return np.sort(index.terms[np.unique(found)])
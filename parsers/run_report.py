@@ -0,0 +1,191 @@
+import os
+import sys
+import json
+import time
+import atexit
+import cProfile
+import pstats
+import resource
+from contextlib import contextmanager
+from datetime import datetime
+
+
+# report of the current run, see start_report. None when no report is recorded
+_report = None
+# records of the stages being run, innermost last
+_running = []
+
+
+def reset_peak_memory():
+    """ Reset the peak resident memory of this process (Linux only), so it can be measured for a single step """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def memory_usage(peak=False):
+    """ Current (or peak) resident memory of this process in bytes. Without /proc, only the peak over the
+        lifetime of the process is known """
+    try:
+        with open('/proc/self/status') as f:
+            fields = dict(line.split(':', 1) for line in f)
+        return int(fields['VmHWM' if peak else 'VmRSS'].split()[0]) * 1024
+    except (OSError, KeyError):
+        # kilobytes on Linux, bytes on macOS
+        scale = 1 if sys.platform == 'darwin' else 1024
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+
+def bytes_read():
+    """ Bytes read by this process so far (Linux only, None elsewhere), including reads served from the page
+        cache. Pages of memory-mapped files are not counted """
+    try:
+        with open('/proc/self/io') as f:
+            return int(dict(line.split(':', 1) for line in f)['rchar'])
+    except (OSError, KeyError):
+        return None
+
+
+def cpu_times():
+    """ (CPU seconds of this process, CPU seconds of its finished worker processes), user and system time """
+    own, children = resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime, children.ru_utime + children.ru_stime
+
+
+def start_report(report_file, script=None, profile_stage=None, profile_file=None):
+    """
+    Start recording a report of this run. Stages run with report_stage (eg. every stage of
+    stage_cache.run_stage) add their wall and CPU time, rows in and out, bytes read and peak memory, and
+    cached steps (stage outputs, compiled ontologies, fasta indexes, file hashes) count their hits and misses.
+    The report is saved to report_file as JSON when the script exits, also if it fails.
+
+    :param report_file: JSON file to save the report to
+    :param script: name of the script, default is the running script
+    :param profile_stage: name of a stage to profile with cProfile, eg. 'propagate'
+    :param profile_file: file to save the profile of that stage to, readable with pstats or snakeviz.
+                         Default is profile_<stage>.prof next to report_file
+    """
+    global _report
+    if profile_stage is not None and profile_file is None:
+        profile_file = os.path.join(os.path.dirname(os.path.abspath(report_file)), f'profile_{profile_stage}.prof')
+    cpu, children_cpu = cpu_times()
+    _report = {'script': script if script is not None else os.path.basename(sys.argv[0]), 'argv': sys.argv[1:],
+               'started': datetime.now().isoformat(timespec='seconds'), 'status': 'failed',
+               'stages': [], 'cache': {}, 'profile': {'stage': profile_stage, 'file': profile_file},
+               '_file': report_file, '_start': (time.perf_counter(), cpu, children_cpu)}
+    atexit.register(save_report)
+
+
+def finish_report():
+    """ Mark the run as completed. A run that exits without calling this is reported as failed """
+    if _report is not None:
+        _report['status'] = 'completed'
+
+
+def _add_count(caches, cache, hits, misses):
+    counts = caches.setdefault(cache, {'hits': 0, 'misses': 0})
+    counts['hits'] += hits
+    counts['misses'] += misses
+
+
+def count_cache(cache, hit):
+    """ Count a hit (or miss if hit is False) of a cache, eg. 'ontology', in the run and in the innermost
+        stage being run """
+    if _report is not None:
+        _add_count(_report['cache'], cache, int(hit), int(not hit))
+        if _running:
+            _add_count(_running[-1].setdefault('cache', {}), cache, int(hit), int(not hit))
+
+
+def report_rows(rows_in=None, rows_out=None, **counts):
+    """ Add the number of rows read and written, and any other counts, eg. labels=..., to the innermost
+        stage being run """
+    if _report is not None and _running:
+        stage = _running[-1]
+        if rows_in is not None:
+            stage['rows_in'] = int(rows_in)
+        if rows_out is not None:
+            stage['rows_out'] = int(rows_out)
+        stage.update({name: int(count) for name, count in counts.items()})
+
+
+@contextmanager
+def report_stage(name, **info):
+    """
+    Record a stage of the run: wall and CPU time, bytes read and peak resident memory of this process while
+    it runs, and any info given, eg. its cache key. Rows are added from inside the stage with report_rows.
+    If it is the stage chosen in start_report, it is also profiled.
+    """
+    if _report is None:
+        yield
+        return
+
+    stage = {'name': name, **info, 'rows_in': None, 'rows_out': None}
+    _running.append(stage)
+    reset_peak_memory()
+    start_time, (start_cpu, start_children_cpu), start_read = time.perf_counter(), cpu_times(), bytes_read()
+    profiler = cProfile.Profile() if name == _report['profile']['stage'] else None
+    if profiler is not None:
+        profiler.enable()
+    try:
+        yield
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(_report['profile']['file'])
+            print(f'Saved profile of stage {name} to {_report["profile"]["file"]}. Slowest functions:')
+            pstats.Stats(profiler).sort_stats('cumulative').print_stats(15)
+        cpu, children_cpu = cpu_times()
+        end_read = bytes_read()
+        stage.update({'wall_seconds': time.perf_counter() - start_time, 'cpu_seconds': cpu - start_cpu,
+                      'workers_cpu_seconds': children_cpu - start_children_cpu,
+                      'bytes_read': end_read - start_read if end_read is not None else None,
+                      'peak_rss_mb': memory_usage(peak=True) / 1024**2})
+        _running.pop()
+        _report['stages'].append(stage)
+
+
+@contextmanager
+def collect_stages():
+    """ List of the stages recorded while in this context, eg. to send the stages run by a background
+        process to the main process, see add_stages """
+    stages = []
+    n_stages = len(_report['stages']) if _report is not None else 0
+    try:
+        yield stages
+    finally:
+        if _report is not None:
+            stages.extend(_report['stages'][n_stages:])
+
+
+def add_stages(stages, **info):
+    """ Add stages recorded by another process (see collect_stages) to the report, with any info given,
+        eg. background=True. Their cache hits are added to those of the run """
+    if _report is None:
+        return
+    for stage in stages:
+        _report['stages'].append({**stage, **info})
+        if 'cached' in stage:
+            count_cache('stages', stage['cached'])
+        for cache, counts in stage.get('cache', {}).items():
+            _add_count(_report['cache'], cache, counts['hits'], counts['misses'])
+
+
+def save_report():
+    """ Save the report to the file given to start_report, with the totals of the run """
+    if _report is None:
+        return
+    start_time, start_cpu, start_children_cpu = _report['_start']
+    cpu, children_cpu = cpu_times()
+    report = {name: value for name, value in _report.items() if not name.startswith('_')}
+    report.update({'wall_seconds': time.perf_counter() - start_time, 'cpu_seconds': cpu - start_cpu,
+                   'workers_cpu_seconds': children_cpu - start_children_cpu,
+                   'peak_rss_mb': max([memory_usage(peak=True) / 1024**2] +
+                                      [stage['peak_rss_mb'] for stage in _report['stages']
+                                       if not stage.get('background')])})
+    with open(_report['_file'], 'w') as f:
+        json.dump(report, f, indent=1)
+    print(f'Saved run report to {_report["_file"]}')
@@ -0,0 +1,105 @@
+import os
+import numpy as np
+from parsers.fasta_index import HEADER_PATTERN
+from parsers.goa_utils import SUBONTOLOGIES
+from parsers.stage_cache import atomic_directory
+
+
+def _iter_raw_sequences(fasta_file):
+    """ Stream (key, residues) pairs of bytes from a fasta file, with keys matched as in fasta_index """
+    with open(fasta_file, 'rb') as handle:
+        key, lines = None, []
+        for line in handle:
+            if line.startswith(b'>'):
+                if key is not None:
+                    yield key, b''.join(lines)
+                key, lines = HEADER_PATTERN.match(line).group(1), []
+            else:
+                lines.append(line.strip())
+        if key is not None:
+            yield key, b''.join(lines)
+
+
+def build_sequence_store(fasta_file, entries, location, rows=None, dedup=False):
+    """
+    Pack the sequences of a set of proteins into a directory of .npy arrays that can be memory-mapped:
+    residues.npy (uint8 ASCII residues of all sequences, one after another), offsets.npy (int64, sequence i is
+    residues[offsets[i]:offsets[i+1]]), entries.npy (sorted accessions) and sequence_ids.npy (int64, sequence of
+    each entry, -1 if it has no sequence in fasta_file).
+
+    If rows is given, the store is also aligned with the label matrices of save_label_matrices: <aspect>_rows.npy
+    is the entry of each row of the label matrix of that aspect.
+
+    :param fasta_file: fasta format file with the sequences, eg. sequences.fasta saved by make_dataset.py
+    :param entries: accessions of the proteins to store
+    :param location: directory to save the store to
+    :param rows: DataFrame with EntryID and aspect of each row of the propagated labels, see goa_utils.propagate_matrix
+    :param dedup: store identical sequences only once
+    :return: store, as returned by load_sequence_store
+    """
+    entries = np.unique(np.asarray(entries).astype(str))
+    entry_index = {entry.encode(): i for i, entry in enumerate(entries)}
+    sequence_ids = np.full(len(entries), -1, dtype=np.int64)
+    sequences, lengths, seen = [], [], {}
+    for key, residues in _iter_raw_sequences(fasta_file):
+        i = entry_index.get(key)
+        if i is None or sequence_ids[i] >= 0:
+            continue
+        if dedup and residues in seen:
+            sequence_ids[i] = seen[residues]
+            continue
+        sequence_ids[i] = len(sequences)
+        if dedup:
+            seen[residues] = len(sequences)
+        sequences.append(residues)
+        lengths.append(len(residues))
+
+    arrays = {'residues': np.frombuffer(b''.join(sequences), dtype=np.uint8),
+              'offsets': np.concatenate([[0], np.cumsum(lengths, dtype=np.int64)]).astype(np.int64),
+              'entries': entries,
+              'sequence_ids': sequence_ids}
+    if rows is not None:
+        for subontology in SUBONTOLOGIES:
+            aspect_entries = rows.EntryID.values[rows.aspect.values == subontology].astype(str)
+            arrays[f'{subontology}_rows'] = np.searchsorted(entries, aspect_entries).astype(np.int64)
+
+    with atomic_directory(location) as tmp_location:
+        for name, array in arrays.items():
+            np.save(os.path.join(tmp_location, f'{name}.npy'), array)
+
+    print(f'Stored {len(sequences)} sequences ({len(arrays["residues"])} residues) '
+          f'of {np.count_nonzero(sequence_ids >= 0)} of {len(entries)} proteins in {location}')
+    return load_sequence_store(location)
+
+
+def load_sequence_store(location):
+    """ Memory-map a store saved by build_sequence_store. Returns a (residues, offsets, entries, sequence_ids)
+        tuple of arrays """
+    return tuple(np.load(os.path.join(location, f'{name}.npy'), mmap_mode='r')
+                 for name in ['residues', 'offsets', 'entries', 'sequence_ids'])
+
+
+def load_store_rows(location, subontology):
+    """ Entry of the sequence store of each row of the label matrix of one aspect (see label_utils.load_label_matrix) """
+    return np.load(os.path.join(location, f'{subontology}_rows.npy'), mmap_mode='r')
+
+
+def store_sequence(store, entry):
+    """
+    Sequence of one entry of a sequence store, without copying or parsing
+
+    :param store: tuple returned by load_sequence_store
+    :param entry: row of the store (int), or accession (str) found with a binary search of the entries
+    :return: uint8 array view of the residues (use .tobytes().decode() for a string), or None if the entry
+             has no sequence
+    """
+    residues, offsets, entries, sequence_ids = store
+    if isinstance(entry, str):
+        row = np.searchsorted(entries, entry)
+        if row == len(entries) or entries[row] != entry:
+            return None
+        entry = row
+    sequence_id = sequence_ids[entry]
+    if sequence_id < 0:
+        return None
+    return residues[offsets[sequence_id]:offsets[sequence_id + 1]]
@@ -0,0 +1,113 @@
+import os
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from parsers.goa_utils import propagate_matrix, category_codes, get_all_taxonomies
+from parsers.label_utils import labels_to_frame, label_order, save_label_matrices
+
+
+def parse_date(date):
+    """ GAF date (YYYYMMDD) as an integer, also accepting YYYY-MM-DD, eg. '2021-06-30' becomes 20210630 """
+    return int(str(date).replace('-', ''))
+
+
+def annotation_dates(annotations_df):
+    """ Date of each annotation as an integer YYYYMMDD, parsed once per distinct date """
+    dates = category_codes(annotations_df.Date)
+    return np.append([parse_date(date) for date in dates.cat.categories], -1)[dates.cat.codes.values]
+
+
+def union_labels(rows, propagated, new_rows, new_propagated):
+    """
+    Union of two sets of propagated labels (see goa_utils.propagate_matrix) that were propagated with the same
+    ontology. Since propagation of a set of annotations is the union of the propagation of each annotation,
+    the labels of a set of annotations can be extended with the labels of new annotations without propagating
+    the old ones again.
+
+    :return: (rows, propagated) with one row per (aspect, EntryID), sorted by aspect and EntryID
+    """
+    all_rows = pd.concat([rows, new_rows], ignore_index=True)
+    row_codes = all_rows.groupby(['aspect', 'EntryID'], sort=False).ngroup().values
+    combined_rows = all_rows.drop_duplicates().reset_index(drop=True)
+    # sparse matrix mapping each row of both sets to its combined row
+    mapping = sp.csr_matrix((np.ones(len(row_codes), dtype=np.int32), (row_codes, np.arange(len(row_codes)))),
+                            shape=(len(combined_rows), len(row_codes)))
+    combined = (mapping @ sp.vstack([propagated, new_propagated]).astype(np.int32)).tocsr() > 0
+    order = label_order(combined_rows)
+    combined = combined[order]
+    combined.sort_indices()
+    return combined_rows.iloc[order].reset_index(drop=True), combined
+
+
+def propagate_snapshots(annotations_df, cutoffs, ontology):
+    """
+    Propagated labels of the annotations made up to each cutoff date (inclusive). Snapshots are computed
+    incrementally: each one only propagates the annotations dated after the previous cutoff and adds them
+    to the labels of the previous snapshot (see union_labels).
+
+    :param annotations_df: cleaned annotations, with the GAF Date column
+    :param cutoffs: cutoff dates as YYYYMMDD or YYYY-MM-DD
+    :param ontology: compiled Ontology
+    :return: generator of (cutoff, rows, terms, propagated) in date order, with cutoff as an integer YYYYMMDD
+             (see parse_date) and where (rows, terms, propagated)
+             are the same as goa_utils.propagate_matrix on the annotations made up to the cutoff
+    """
+    dates = annotation_dates(annotations_df)
+    rows, terms, propagated = propagate_matrix(annotations_df.iloc[:0], ontology)
+    previous_cutoff = -1
+    for cutoff in sorted(set(map(parse_date, cutoffs))):
+        new = np.flatnonzero((dates > previous_cutoff) & (dates <= cutoff))
+        print(f'Propagating {len(new)} annotations made after {previous_cutoff} up to {cutoff}')
+        new_rows, terms, new_propagated = propagate_matrix(annotations_df.iloc[new], ontology)
+        rows, propagated = union_labels(rows, propagated, new_rows, new_propagated)
+        previous_cutoff = cutoff
+        yield cutoff, rows, terms, propagated
+
+
+def new_targets(previous_rows, rows, terms, propagated):
+    """
+    Proteins newly annotated in an aspect between two snapshots, eg. to use as targets of a time-split benchmark
+    as in CAFA. A protein is a target of an aspect if it has labels of that aspect in the later snapshot and
+    none in the earlier one. Targets are 'NK' (no knowledge) if the protein had no labels in any aspect
+    in the earlier snapshot and 'LK' (limited knowledge) otherwise.
+
+    :param previous_rows: rows of the labels of the earlier snapshot
+    :param rows, terms, propagated: labels of the later snapshot
+    :return: DataFrame with columns EntryID, term, aspect and knowledge, with all the labels of each target
+    """
+    previous_pairs = pd.MultiIndex.from_frame(previous_rows[['aspect', 'EntryID']])
+    target_rows = np.flatnonzero(~pd.MultiIndex.from_frame(rows[['aspect', 'EntryID']]).isin(previous_pairs))
+    targets = labels_to_frame(rows.iloc[target_rows], terms, propagated[target_rows])
+    targets['knowledge'] = np.where(targets.EntryID.isin(previous_rows.EntryID), 'LK', 'NK')
+    return targets
+
+
+def save_snapshots(annotations_df, cutoffs, ontology, location, labels='tsv'):
+    """
+    Save the propagated labels of each cutoff date to <location>/<cutoff>/ (terms.tsv and/or labels/, as in
+    process_goa.py, and taxonomy.tsv) and the proteins newly annotated between consecutive cutoffs to
+    <location>/targets_<cutoff>_<next cutoff>.tsv (see new_targets).
+
+    :param annotations_df: cleaned annotations, with the GAF Date column
+    :param cutoffs: cutoff dates as YYYYMMDD or YYYY-MM-DD
+    :param ontology: compiled Ontology
+    :param location: directory to save the snapshots to
+    :param labels: 'tsv', 'matrix' or 'both'
+    """
+    previous_cutoff, previous_rows = None, None
+    for cutoff, rows, terms, propagated in propagate_snapshots(annotations_df, cutoffs, ontology):
+        snapshot_location = os.path.join(location, str(cutoff))
+        os.makedirs(snapshot_location, exist_ok=True)
+        if labels in ['tsv', 'both']:
+            labels_to_frame(rows, terms, propagated).to_csv(os.path.join(snapshot_location, 'terms.tsv'),
+                                                            index=False, sep='\t')
+        if labels in ['matrix', 'both']:
+            save_label_matrices(rows, terms, propagated, os.path.join(snapshot_location, 'labels'))
+        taxdf = get_all_taxonomies(annotations_df[annotations_df.DB_Object_ID.isin(rows.EntryID)])
+        taxdf.to_csv(os.path.join(snapshot_location, 'taxonomy.tsv'), index=False, sep='\t')
+
+        if previous_rows is not None:
+            targets = new_targets(previous_rows, rows, terms, propagated)
+            print(f'{targets.EntryID.nunique()} proteins newly annotated between {previous_cutoff} and {cutoff}')
+            targets.to_csv(os.path.join(location, f'targets_{previous_cutoff}_{cutoff}.tsv'), index=False, sep='\t')
+        previous_cutoff, previous_rows = cutoff, rows
@@ -0,0 +1,186 @@
+import os
+import json
+import shutil
+import hashlib
+import urllib.request
+from contextlib import contextmanager
+from parsers.run_report import report_stage, count_cache
+
+
+def file_hash(filename, block_size=1024**2):
+    """ SHA-256 hex digest of the contents of a file """
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as handle:
+        for block in iter(lambda: handle.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def download_file(source_path, save_path):
+    """ Download source_path to save_path, unless it was already downloaded. Gzipped files are kept compressed,
+        goa_utils.filter_evidence reads them directly """
+    if not os.path.exists(save_path):
+        urllib.request.urlretrieve(source_path, filename=save_path)
+    return save_path
+
+
+@contextmanager
+def atomic_directory(location, replace=True):
+    """
+    Write a directory atomically. Yields a temporary directory next to location, which is renamed to location
+    when the block completes, so an interrupted write never leaves a partial directory that would be read later.
+
+    :param location: directory to write
+    :param replace: replace location if it exists. If False, a location written by another process in the
+                    meantime is kept, eg. for cached outputs that are the same whoever writes them
+    """
+    tmp_location = f'{location}.tmp{os.getpid()}'
+    shutil.rmtree(tmp_location, ignore_errors=True)
+    os.makedirs(tmp_location)
+    try:
+        yield tmp_location
+    except BaseException:
+        shutil.rmtree(tmp_location, ignore_errors=True)
+        raise
+    if replace and os.path.isdir(location):
+        shutil.rmtree(location)
+    try:
+        os.rename(tmp_location, location)
+    except OSError:
+        # another process wrote the same directory first
+        shutil.rmtree(tmp_location, ignore_errors=True)
+
+
+def input_fingerprint(path, cache_dir):
+    """ Content hash of an input file. Hashes are remembered in <cache_dir>/file_hashes.json together with
+        the size and modification time of the file, so a file is only hashed again when it changes.
+        The file is not locked: processes running in parallel with the same cache_dir (eg. the workers of
+        process_batch.py) must have their inputs hashed by the parent first, so they only read it """
+    hashes_file = os.path.join(cache_dir, 'file_hashes.json')
+    hashes = {}
+    if os.path.exists(hashes_file):
+        with open(hashes_file) as f:
+            hashes = json.load(f)
+
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    saved = hashes.get(path)
+    hit = saved is not None and saved['size'] == stat.st_size and saved['mtime'] == stat.st_mtime_ns
+    count_cache('file_hashes', hit)
+    if hit:
+        return saved['sha256']
+
+    print(f'Hashing input file {path}')
+    digest = file_hash(path)
+    hashes[path] = {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'sha256': digest}
+    tmp_file = f'{hashes_file}.tmp{os.getpid()}'
+    with open(tmp_file, 'w') as f:
+        json.dump(hashes, f, indent=1)
+    os.replace(tmp_file, hashes_file)
+    return digest
+
+
+def stage_key(cache_dir, name, params=None, files=(), depends=()):
+    """ Cache key of a stage: a hash of its name, parameters, the contents of its input files
+        and the keys of the stages it depends on """
+    digest = hashlib.sha256(name.encode())
+    digest.update(json.dumps(params, sort_keys=True, default=str).encode())
+    for path in files:
+        digest.update(input_fingerprint(path, cache_dir).encode())
+    for key in depends:
+        digest.update(key.encode())
+    return digest.hexdigest()
+
+
+def run_stage(cache_dir, name, build, load, params=None, files=(), depends=()):
+    """
+    Run one stage of the pipeline, or reuse its output from a previous run with the same inputs.
+
+    The output of a stage is a directory <cache_dir>/<name>-<key>, where key is a hash of the stage inputs
+    (see stage_key). The directory is written with atomic_directory, so an interrupted run never leaves
+    a partial output that would be reused later.
+    Time, memory and cache hits of the stage are added to the run report, see run_report.report_stage.
+
+    :param cache_dir: directory of cached stage outputs
+    :param name: name of the stage
+    :param build: function that takes a directory and writes the output of the stage to it
+    :param load: function that takes the output directory of the stage and returns its result
+    :param params: parameters of the stage that change its output. Must be JSON serializable
+    :param files: input files of the stage
+    :param depends: keys of the stages whose outputs are used by this stage
+    :return: (result of load, key of this stage)
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    key = stage_key(cache_dir, name, params=params, files=files, depends=depends)
+    location = os.path.join(cache_dir, f'{name}-{key[:16]}')
+
+    cached = os.path.isdir(location)
+    count_cache('stages', cached)
+    with report_stage(name, key=key[:16], cached=cached, location=location):
+        if cached:
+            print(f'Reusing {name} output from {location}')
+        else:
+            # another run may finish the same stage first
+            with atomic_directory(location, replace=False) as tmp_location:
+                build(tmp_location)
+        result = load(location)
+
+    return result, key
+
+
+def published_outputs(dest):
+    """ Names of the outputs saved to dest by earlier runs, as recorded in <dest>/published.json by record_outputs """
+    manifest_file = os.path.join(dest, 'published.json')
+    if not os.path.exists(manifest_file):
+        return []
+    with open(manifest_file) as f:
+        return json.load(f)
+
+
+def _save_manifest(names, dest):
+    manifest_file = os.path.join(dest, 'published.json')
+    tmp_file = f'{manifest_file}.tmp{os.getpid()}'
+    with open(tmp_file, 'w') as f:
+        json.dump(sorted(names), f, indent=1)
+    os.replace(tmp_file, manifest_file)
+
+
+def record_outputs(names, dest):
+    """ Record that the named files or directories in dest are outputs of the pipeline, so a later run
+        can replace or remove them (see remove_outputs) """
+    _save_manifest(set(published_outputs(dest)) | set(names), dest)
+
+
+def remove_outputs(names, dest):
+    """ Remove the named outputs of an earlier run from dest. Only outputs recorded by record_outputs are
+        removed, files or directories that were already in dest are never touched """
+    published = set(published_outputs(dest))
+    removed = published & set(names)
+    for name in removed:
+        target = os.path.join(dest, name)
+        if os.path.isdir(target):
+            shutil.rmtree(target)
+        elif os.path.exists(target):
+            os.remove(target)
+    if removed:
+        _save_manifest(published - removed, dest)
+
+
+def publish(location, names, dest, outputs=()):
+    """ Copy the named output files or directories of a stage from its cache directory to dest and record them
+        (see record_outputs). outputs are the names of all the outputs that could be in dest: those that an
+        earlier run published and this run did not produce are removed, so dest never mixes the outputs of
+        different runs """
+    remove_outputs([name for name in outputs if name not in names], dest)
+    published = set(published_outputs(dest))
+    # a directory that was already in dest is only added to, and is not recorded so it is never removed
+    unmanaged = [name for name in names if name not in published and os.path.isdir(os.path.join(dest, name))]
+    for name in names:
+        source, target = os.path.join(location, name), os.path.join(dest, name)
+        if os.path.isdir(target) and name in published:
+            shutil.rmtree(target)
+        if os.path.isdir(source):
+            shutil.copytree(source, target, dirs_exist_ok=True)
+        else:
+            shutil.copyfile(source, target)
+    record_outputs([name for name in names if name not in unmanaged], dest)
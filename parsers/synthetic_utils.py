@@ -0,0 +1,243 @@
+import os
+import gzip
+import numpy as np
+import pandas as pd
+from parsers.goa_utils import GAF_FIELDS
+from parsers.obo_utils import NAMESPACE_ASPECTS
+
+
+# approximate share of each evidence code in a full UniProt GOA release: mostly electronic (IEA) and
+# phylogenetic (IBA) annotations, with a few percent of experimental, inferred and high-throughput ones
+EVIDENCE_MIX = {'IEA': 0.70, 'IBA': 0.08, 'ISS': 0.02, 'ISO': 0.03, 'ISA': 0.01, 'NAS': 0.01, 'ND': 0.01,
+                'IDA': 0.04, 'IPI': 0.03, 'IMP': 0.02, 'IGI': 0.004, 'IEP': 0.004, 'EXP': 0.002,
+                'TAS': 0.01, 'IC': 0.002, 'HDA': 0.01, 'HTP': 0.004, 'HMP': 0.003, 'HGI': 0.001, 'HEP': 0.001}
+
+# approximate share of annotations of each aspect
+ASPECT_MIX = {'P': 0.40, 'F': 0.35, 'C': 0.25}
+
+# qualifiers of each aspect, the first one being the most common
+ASPECT_QUALIFIERS = {'P': ['involved_in', 'acts_upstream_of_or_within'],
+                     'F': ['enables', 'contributes_to'],
+                     'C': ['located_in', 'part_of', 'is_active_in']}
+
+# share of proteins of each taxon. Every protein has a single taxon, as get_all_taxonomies expects
+TAXON_MIX = {9606: 0.25, 10090: 0.2, 10116: 0.1, 559292: 0.1, 7227: 0.1, 6239: 0.1, 3702: 0.1, 83333: 0.05}
+
+# sources of the annotations of each evidence code
+ASSIGNED_BY = {'IEA': ['InterPro', 'UniProt', 'Ensembl', 'ARBA', 'UniRule'], 'IBA': ['GO_Central']}
+CURATORS = ['UniProt', 'MGI', 'RGD', 'SGD', 'FlyBase', 'WB', 'TAIR', 'GO_Central', 'IntAct', 'ComplexPortal']
+
+# root term of each GO namespace
+ROOTS = {'biological_process': 'GO:0008150', 'cellular_component': 'GO:0005575', 'molecular_function': 'GO:0003674'}
+
+# amino acids and their approximate frequency in UniProtKB
+AMINO_ACIDS = {'A': 8.25, 'R': 5.53, 'N': 4.06, 'D': 5.45, 'C': 1.37, 'Q': 3.93, 'E': 6.75, 'G': 7.07, 'H': 2.27,
+               'I': 5.96, 'L': 9.66, 'K': 5.84, 'M': 2.42, 'F': 3.86, 'P': 4.70, 'S': 6.56, 'T': 5.34, 'W': 1.08,
+               'Y': 2.92, 'V': 6.87}
+
+# number of GAF lines or fasta records generated at once
+GENERATE_CHUNK = 1000000
+
+
+def _mix(rng, mix, size):
+    """ Draw size values from a dict of value to share """
+    values = list(mix)
+    shares = np.array([mix[value] for value in values], dtype=float)
+    return np.array(values)[rng.choice(len(values), size=size, p=shares / shares.sum())]
+
+
+def _skewed(rng, n, size, power=2.0):
+    """ Draw size integers in [0, n), with small values more frequent, eg. a few proteins with many annotations """
+    return np.minimum((n * rng.random(size) ** power).astype(np.int64), n - 1)
+
+
+def synthetic_accessions(ids, prefix='S'):
+    """ UniProt-like accessions of synthetic proteins, eg. 12 becomes S00000012 """
+    return np.char.add(prefix, np.char.zfill(np.asarray(ids).astype(str), 8))
+
+
+def generate_obo(obo_file, n_terms=45000, obsolete=0.05, seed=0):
+    """
+    Write a GO-like ontology: three namespaces with a root each and a DAG of is_a edges, plus part_of and
+    regulates relationships. Each term has one to three parents among the terms before it, mostly close to
+    it, so the graph is about as deep as GO. A share of the terms are obsolete, without parents.
+
+    :param obo_file: OBO file to write
+    :param n_terms: approximate number of terms (GO has about 45000, including obsolete terms)
+    :param obsolete: share of obsolete terms
+    :param seed: random seed
+    :return: dict of GAF aspect letter to array of the IDs of the terms of that aspect, obsolete terms included
+    """
+    rng = np.random.default_rng(seed)
+    lines = ['format-version: 1.2', 'ontology: go', '']
+    aspect_terms = {}
+    next_id = 100000
+    for namespace, root in ROOTS.items():
+        aspect = NAMESPACE_ASPECTS[namespace]
+        size = max(int(n_terms * ASPECT_MIX[aspect]), 2)
+        terms = [root] + [f'GO:{i:07d}' for i in range(next_id, next_id + size - 1)]
+        next_id += size
+        is_obsolete = rng.random(size) < obsolete
+        is_obsolete[0] = False
+        live = []
+        for i, term in enumerate(terms):
+            lines += ['[Term]', f'id: {term}', f'name: synthetic {namespace.replace("_", " ")} {i}',
+                      f'namespace: {namespace}']
+            if is_obsolete[i]:
+                lines.append('is_obsolete: true')
+            elif live:
+                # parents mostly among the last terms added, which makes deep paths to the root
+                n_parents = rng.choice([1, 2, 3], p=[0.6, 0.3, 0.1])
+                parents = {live[int(len(live) * rng.random() ** 0.2)] for _ in range(n_parents)}
+                lines += [f'is_a: {parent}' for parent in sorted(parents)]
+                if rng.random() < 0.2:
+                    lines.append(f'relationship: part_of {live[int(len(live) * rng.random())]}')
+                if rng.random() < 0.1:
+                    lines.append(f'relationship: regulates {live[int(len(live) * rng.random())]}')
+            if not is_obsolete[i]:
+                live.append(term)
+            lines.append('')
+        aspect_terms[aspect] = np.array(terms)
+
+    with open(obo_file, 'w') as f:
+        f.write('\n'.join(lines))
+    return aspect_terms
+
+
+def generate_gaf(gaf_file, n_rows, aspect_terms, n_proteins=None, duplicates=0.05, negative=0.005, seed=0):
+    """
+    Write a GAF 2.2 file with the evidence, aspect and qualifier mix of a UniProt GOA release (see EVIDENCE_MIX,
+    ASPECT_MIX). Annotations of a few proteins and terms are much more frequent than the rest, a share of
+    them are negative (NOT) or repeated with another reference, and a few are from other databases than UniProtKB.
+
+    :param gaf_file: GAF file to write, gzipped if it ends in .gz
+    :param n_rows: number of annotation lines
+    :param aspect_terms: dict of aspect letter to term IDs, as returned by generate_obo
+    :param n_proteins: number of proteins (default about 10 annotations per protein). Protein i has accession
+                       synthetic_accessions(i)
+    :param duplicates: share of lines that repeat another line of the same chunk with a different reference
+    :param negative: share of lines with a NOT qualifier
+    :param seed: random seed
+    :return: number of proteins
+    """
+    rng = np.random.default_rng(seed)
+    n_proteins = n_proteins if n_proteins is not None else max(n_rows // 10, 1)
+    protein_taxa = _mix(rng, TAXON_MIX, n_proteins)
+    taxon_names = {taxon: f'taxon:{taxon}' for taxon in TAXON_MIX}
+
+    handle = gzip.open(gaf_file, 'wt') if gaf_file.endswith('.gz') else open(gaf_file, 'w')
+    with handle:
+        handle.write('!gaf-version: 2.2\n!generated-by: GOdatasets synthetic_utils\n')
+        for start in range(0, n_rows, GENERATE_CHUNK):
+            size = min(GENERATE_CHUNK, n_rows - start)
+            n_unique = max(size - int(size * duplicates), 1)
+            proteins = _skewed(rng, n_proteins, n_unique)
+            aspects = _mix(rng, ASPECT_MIX, n_unique)
+            terms = np.empty(n_unique, dtype=object)
+            qualifiers = np.empty(n_unique, dtype=object)
+            for aspect, candidates in aspect_terms.items():
+                in_aspect = np.flatnonzero(aspects == aspect)
+                terms[in_aspect] = candidates[_skewed(rng, len(candidates), len(in_aspect), power=3.0)]
+                options = ASPECT_QUALIFIERS[aspect]
+                qualifiers[in_aspect] = np.array(options)[(rng.random(len(in_aspect)) < 0.1) *
+                                                          rng.integers(1, len(options), len(in_aspect))]
+            qualifiers = qualifiers.astype(str)
+            qualifiers = np.where(rng.random(n_unique) < negative, np.char.add('NOT|', qualifiers), qualifiers)
+            evidence = _mix(rng, EVIDENCE_MIX, n_unique)
+            db = np.array(['UniProtKB', 'RNAcentral', 'ComplexPortal'])[
+                rng.choice(3, size=n_unique, p=[0.98, 0.01, 0.01])]
+
+            # repeated annotations only differ in their reference
+            rows = np.concatenate([np.arange(n_unique), rng.integers(0, n_unique, size - n_unique)])
+            proteins, aspects, terms = proteins[rows], aspects[rows], terms[rows]
+            qualifiers, evidence, db = qualifiers[rows], evidence[rows], db[rows]
+            accessions = synthetic_accessions(proteins)
+            taxa = pd.Series(protein_taxa[proteins]).map(taxon_names).values
+            # a few annotations of interactions with another species
+            taxa = np.where(rng.random(size) < 0.01, np.char.add(taxa.astype(str), '|taxon:562'), taxa)
+            references = np.where(np.isin(evidence, ['IEA', 'IBA']),
+                                  np.char.add('GO_REF:00000', rng.integers(10, 99, size).astype(str)),
+                                  np.char.add('PMID:', rng.integers(1000000, 38000000, size).astype(str)))
+            manual = ~np.isin(evidence, list(ASSIGNED_BY))
+            assigned_by = np.array(CURATORS)[rng.integers(0, len(CURATORS), size)]
+            for code, sources in ASSIGNED_BY.items():
+                is_code = np.flatnonzero(evidence == code)
+                assigned_by[is_code] = np.array(sources)[rng.integers(0, len(sources), len(is_code))]
+            dates = (rng.integers(2003, 2024, size) * 10000 + rng.integers(1, 13, size) * 100
+                     + rng.integers(1, 29, size))
+
+            gaf_df = pd.DataFrame({
+                'DB': db, 'DB_Object_ID': accessions, 'DB_Object_Symbol': np.char.add('GENE', proteins.astype(str)),
+                'Qualifier': qualifiers, 'GO_ID': terms, 'DB:Reference': references, 'Evidence': evidence,
+                'With': np.where(manual, '', np.char.add('InterPro:IPR', np.char.zfill(
+                    rng.integers(0, 50000, size).astype(str), 6))),
+                'Aspect': aspects, 'DB_Object_Name': np.char.add('Synthetic protein ', proteins.astype(str)),
+                'Synonym': np.char.add(accessions, '|SYN'), 'DB_Object_Type': 'protein', 'Taxon_ID': taxa,
+                'Date': dates, 'Assigned_By': assigned_by, 'Annotation_Extension': '', 'Gene_Product_Form_ID': ''},
+                columns=GAF_FIELDS)
+            gaf_df.to_csv(handle, sep='\t', header=False, index=False)
+    return n_proteins
+
+
+def generate_fasta(fasta_file, accessions, prefix='sp', mean_length=400, seed=0):
+    """
+    Write a UniProt-like fasta file with random sequences, eg. for Swiss-Prot (prefix 'sp') or TrEMBL ('tr').
+    Sequence lengths are log-normal, with residues drawn with their UniProtKB frequencies (see AMINO_ACIDS).
+
+    :param fasta_file: fasta file to write
+    :param accessions: accessions of the records, in file order
+    :param prefix: database of the headers, eg. '>sp|S00000012|S00000012_SYNTH ...'
+    :param mean_length: approximate mean length of the sequences
+    :param seed: random seed
+    """
+    rng = np.random.default_rng(seed)
+    alphabet = np.frombuffer(''.join(AMINO_ACIDS).encode(), dtype=np.uint8)
+    frequencies = np.array(list(AMINO_ACIDS.values()))
+    with open(fasta_file, 'wb') as handle:
+        for start in range(0, len(accessions), GENERATE_CHUNK):
+            chunk = accessions[start:start + GENERATE_CHUNK]
+            lengths = np.clip(rng.lognormal(np.log(mean_length) - 0.18, 0.6, len(chunk)), 30, 35000).astype(np.int64)
+            residues = alphabet[rng.choice(len(alphabet), size=lengths.sum(), p=frequencies / frequencies.sum())]
+            residues = residues.tobytes()
+            offsets = np.concatenate([[0], np.cumsum(lengths)])
+            records = []
+            for accession, begin, end in zip(chunk, offsets[:-1], offsets[1:]):
+                sequence = residues[begin:end]
+                records.append(f'>{prefix}|{accession}|{accession}_SYNTH Synthetic protein OS=Synthetic organism '
+                               f'OX=32630 PE=4 SV=1\n'.encode())
+                records.extend(sequence[i:i + 60] + b'\n' for i in range(0, len(sequence), 60))
+            handle.write(b''.join(records))
+
+
+def generate_dataset(location, n_rows, n_terms=45000, swissprot=0.5, unannotated=1.0, gzipped=False, seed=0):
+    """
+    Generate all the inputs of the pipeline in a directory: go.obo (see generate_obo), goa_synthetic.gaf
+    (see generate_gaf), uniprot_sprot.fasta with a share of the annotated proteins and uniprot_trembl.fasta with
+    the other annotated proteins and some that have no annotations, as in UniProt.
+
+    :param location: directory to write the files to
+    :param n_rows: number of GAF lines
+    :param n_terms: approximate number of ontology terms
+    :param swissprot: share of the annotated proteins in Swiss-Prot
+    :param unannotated: number of proteins without annotations in TrEMBL, relative to the number annotated
+    :param gzipped: write the GAF file gzipped
+    :param seed: random seed
+    :return: dict of input name ('obo', 'gaf', 'swissprot', 'trembl') to file, and 'proteins' to the number
+             of proteins of the GAF file
+    """
+    os.makedirs(location, exist_ok=True)
+    files = {'obo': os.path.join(location, 'go.obo'),
+             'gaf': os.path.join(location, 'goa_synthetic.gaf' + ('.gz' if gzipped else '')),
+             'swissprot': os.path.join(location, 'uniprot_sprot.fasta'),
+             'trembl': os.path.join(location, 'uniprot_trembl.fasta')}
+    aspect_terms = generate_obo(files['obo'], n_terms=n_terms, seed=seed)
+    n_proteins = generate_gaf(files['gaf'], n_rows, aspect_terms, seed=seed + 1)
+
+    rng = np.random.default_rng(seed + 2)
+    in_swissprot = rng.random(n_proteins) < swissprot
+    generate_fasta(files['swissprot'], synthetic_accessions(np.flatnonzero(in_swissprot)), prefix='sp', seed=seed + 3)
+    # unannotated proteins get the accessions after those of the GAF file
+    trembl_ids = np.concatenate([np.flatnonzero(~in_swissprot),
+                                 np.arange(n_proteins, n_proteins + int(n_proteins * unannotated))])
+    generate_fasta(files['trembl'], synthetic_accessions(rng.permutation(trembl_ids)), prefix='tr', seed=seed + 4)
+    return {**files, 'proteins': n_proteins}
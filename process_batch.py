@@ -0,0 +1,135 @@
+import os
+import argparse
+import pandas as pd
+from multiprocessing import Pool
+from functools import partial
+from parsers.obo_utils import load_ontology
+from parsers.label_utils import labels_to_frame, save_label_matrices
+from parsers.stage_cache import download_file, input_fingerprint, publish, record_outputs, remove_outputs
+from parsers.pipeline_utils import LABEL_OUTPUTS, filter_stage, label_stages, merge_propagated
+
+
+# ontology shared by the species processed in a worker, see init_worker
+_ontology = None
+
+
+def species_name(goa_file):
+    """ Name of the dataset of a GAF file, eg. goa_human.gaf.gz becomes human """
+    name = os.path.basename(goa_file).split('.')[0]
+    return name[len('goa_'):] if name.startswith('goa_') else name
+
+
+def init_worker(obo_file, cache_dir):
+    """ Load the ontology once per worker. The compiled ontology is memory-mapped read-only, so all
+        workers share the same pages (see obo_utils.load_ontology) """
+    global _ontology
+    _ontology = load_ontology(obo_file, cache_dir=cache_dir)
+
+
+def process_species(goa_file, obo_file, cache_dir, highthr, labels):
+    """ Filter, clean and propagate the annotations of one GAF file with the ontology of the worker
+
+    :return: (species name, directory of the output files, directory of the propagated labels)
+    """
+    name = species_name(goa_file)
+    print(f'Processing {name} annotations from {goa_file}')
+    # each species is filtered by a single process, the species are processed in parallel
+    filtered_file, filter_key = filter_stage(cache_dir, goa_file, highthr=highthr, workers=1)
+    outputs_location, release = label_stages(cache_dir, filtered_file, filter_key, obo_file,
+                                             labels=labels, ontology=_ontology)
+    return name, outputs_location, release['propagated']
+
+
+if __name__ == '__main__':
+    """
+    Process GOA annotations of several species at once. The ontology is loaded once and shared by a pool of workers
+    that process one species each. Outputs of each species are saved to <dest>/<species>/
+    """
+
+    parser = argparse.ArgumentParser(description='Filter and propagate Gene Ontology annotations of several species in parallel')
+    parser.add_argument('--dest', '-d', default='.',
+                        help='Path to save processed files. Will be created if does not exist.')
+    parser.add_argument('--gaf', '-g', nargs='+', default=[],
+                        help='Paths to GAF files with annotations, eg. raw_data/goa_human.gaf.gz')
+    parser.add_argument('--species', '-s', nargs='+', default=[],
+                        help='Species names to download annotations for from https://ftp.ebi.ac.uk/pub/databases/GO/goa/, eg. human mouse (see get_raw_annotations.sh)')
+    parser.add_argument('--obo', '-o', default=None,
+                        help='Path to OBO graph file if local. If empty (default) current OBO structure at run-time will be downloaded from http://purl.obolibrary.org/obo/go/go-basic.obo')
+    parser.add_argument('--high', action='store_true',
+                        help='Flag to include high-throughput evidence codes')
+    parser.add_argument('--processes', '-p', type=int, default=None,
+                        help='Number of species processed in parallel (default: number of CPUs or of species if fewer)')
+    parser.add_argument('--labels', choices=['tsv', 'matrix', 'both'], default='tsv',
+                        help='Save propagated labels as terms.tsv (default), as sparse label matrices per aspect in labels/, or both')
+    parser.add_argument('--merge', action='store_true',
+                        help='Flag to also save a dataset with the annotations of all species in <dest>/merged')
+    parser.add_argument('--cache-dir', default=None,
+                        help='Directory of cached intermediate results (default <dest>/cache), shared by all species')
+    args = parser.parse_args()
+
+    data_location = args.dest
+    os.makedirs(data_location, exist_ok=True)
+    cache_dir = args.cache_dir if args.cache_dir is not None else os.path.join(data_location, 'cache')
+
+    # get raw annotations
+    goa_files = list(args.gaf)
+    for goa_file in goa_files:
+        assert os.path.exists(goa_file), f'GAF file {goa_file} does not exist'
+    raw_location = os.path.join(data_location, 'raw_data')
+    for species in args.species:
+        os.makedirs(raw_location, exist_ok=True)
+        gaf_file = f'goa_{species}.gaf.gz'
+        source = f'https://ftp.ebi.ac.uk/pub/databases/GO/goa/{species.upper()}/{gaf_file}'
+        print(f'Downloading GO Annotation File (GAF) file {gaf_file} from {source}')
+        goa_files.append(download_file(source, os.path.join(raw_location, gaf_file)))
+    assert len(goa_files) > 0, 'No GAF files or species given'
+    names = [species_name(goa_file) for goa_file in goa_files]
+    assert len(set(names)) == len(names), f'Several GAF files have the same species name: {names}'
+
+    # get ontology structure
+    if args.obo is not None:
+        obo_file = args.obo
+    else:
+        print('Downloading OBO file from http://purl.obolibrary.org/obo/go/go-basic.obo')
+        obo_file = download_file('http://purl.obolibrary.org/obo/go/go-basic.obo',
+                                 os.path.join(data_location, 'go-basic.obo'))
+
+    # hash the inputs before starting the workers: file_hashes.json is not locked, so workers only read it
+    os.makedirs(cache_dir, exist_ok=True)
+    for path in goa_files + [obo_file]:
+        input_fingerprint(path, cache_dir)
+    # compile the ontology once before starting the workers too, which then only memory-map it
+    load_ontology(obo_file, cache_dir=cache_dir)
+
+    processes = args.processes if args.processes is not None else min(os.cpu_count(), len(goa_files))
+    print(f'Processing {len(goa_files)} species with {processes} processes')
+    results = {}
+    with Pool(processes, initializer=init_worker, initargs=(obo_file, cache_dir)) as pool:
+        species_results = pool.imap_unordered(partial(process_species, obo_file=obo_file, cache_dir=cache_dir,
+                                                      highthr=args.high, labels=args.labels), goa_files)
+        for name, outputs_location, propagated_location in species_results:
+            species_location = os.path.join(data_location, name)
+            os.makedirs(species_location, exist_ok=True)
+            output_names = sorted(os.listdir(outputs_location))
+            print(f'Saving {name} {", ".join(output_names)} to {species_location}')
+            publish(outputs_location, output_names, species_location, outputs=LABEL_OUTPUTS)
+            results[name] = (outputs_location, propagated_location)
+
+    if args.merge:
+        merged_location = os.path.join(data_location, 'merged')
+        os.makedirs(merged_location, exist_ok=True)
+        print(f'Saving dataset of all species to {merged_location}')
+        # in the order the species were given
+        rows, terms, propagated = merge_propagated([results[name][1] for name in names])
+        remove_outputs(['labels'] if args.labels == 'tsv' else ['terms.tsv'] if args.labels == 'matrix' else [],
+                       merged_location)
+        if args.labels in ['tsv', 'both']:
+            labels_to_frame(rows, terms, propagated).to_csv(os.path.join(merged_location, 'terms.tsv'),
+                                                            index=False, sep='\t')
+        if args.labels in ['matrix', 'both']:
+            save_label_matrices(rows, terms, propagated, os.path.join(merged_location, 'labels'))
+        taxdf = pd.concat([pd.read_csv(os.path.join(results[name][0], 'taxonomy.tsv'), sep='\t') for name in names])
+        taxdf = taxdf.drop_duplicates('EntryID')
+        taxdf.to_csv(os.path.join(merged_location, 'taxonomy.tsv'), index=False, sep='\t')
+        record_outputs({'tsv': ['terms.tsv'], 'matrix': ['labels'], 'both': ['terms.tsv', 'labels']}[args.labels]
+                       + ['taxonomy.tsv'], merged_location)
@@ -1,8 +1,9 @@
 import time
-import sqlite3
-from tqdm import tqdm
-from Bio import SeqIO, SeqRecord, Seq
+from Bio import SeqIO
 import argparse
+from parsers.fasta_index import build_fasta_index, export_sqlite
+# read_fasta_sql moved to parsers.fasta_utils, still importable from here
+from parsers.fasta_utils import read_fasta_sql
 
 
 def create_sql_db(input_file):
@@ -24,35 +25,22 @@ def create_sql_db(input_file):
     return indices_sql
 
 
-def read_fasta_sql(index_file, sequence_file, proteins):
-    """
-    Find a set of proteins in a fasta sequence file that has been indexed into a
-    sqlite file by biopython's Bio.SeqIO.index_db method
-    :param index_file: SQLite index file for sequence_file
-    :param sequence_file: fasta format file with sequences indexed by index_file
-    :param proteins: list or set of proteins to be matched. These must match the key function for the database
-    :return: list of matching records. List items are a biopython SeqRecord object
-    """
-    con = sqlite3.connect(index_file)
+def create_native_index(input_file, workers=1, sqlite=False):
+
+    save_file = input_file + '.fidx'
+
+    print("Creating index for fasta file {}. Will be saved to {}".format(input_file, save_file))
+    start_time = time.time()
+
+    index = build_fasta_index(input_file, save_file, workers=workers)
+    if sqlite:
+        print("Exporting index to SQLite file {}".format(input_file + '.idx'))
+        export_sqlite(index, input_file, input_file + '.idx')
 
-    matching_records = [] 
-    with open(sequence_file, 'r') as filehandle:
-        for gene in tqdm(set(proteins)):
-            sql = f'select * from offset_data where key = "{gene}"'
-            cursor = con.execute(sql)
-            record = cursor.fetchone()
-            if record is not None:
-                offset = record[-2]
-                length = record[-1]
-                filehandle.seek(offset, 0)
-                seq_record = filehandle.read(length)
-                sequence = ''.join(seq_record.split('\n')[1:-1])
-                description = seq_record.split('\n')[0].split('>')[1]
-                rec=SeqRecord.SeqRecord(Seq.Seq(sequence), description=description, 
-                                        id=gene, name=description.split(' ')[0])
-                matching_records.append(rec)
+    duration = time.time()-start_time
 
-    return matching_records
+    print(f'{duration:.2f} s elapsed')
+    return index
 
 
 if __name__ == '__main__':
@@ -63,6 +51,15 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(
         description='Create or read SQL index/db of Uniprot fasta protein sequence files.')
     parser.add_argument('--fasta', help='Path to raw fasta file')
+    parser.add_argument('--native', action='store_true',
+                        help='Create a numpy index (<fasta>.fidx) by scanning the file directly. Much faster than the SQLite index')
+    parser.add_argument('--sqlite', action='store_true',
+                        help='With --native, also export the index as a Bio.SeqIO.index_db SQLite file (<fasta>.idx)')
+    parser.add_argument('--workers', '-w', type=int, default=1,
+                        help='Number of processes used to create the --native index (default 1)')
     args = parser.parse_args()    
 
-    create_sql_db(args.fasta) 
+    if args.native:
+        create_native_index(args.fasta, workers=args.workers, sqlite=args.sqlite)
+    else:
+        create_sql_db(args.fasta) 
@@ -1,21 +1,12 @@
 import os
 import argparse
-import pandas as pd
-import urllib
-from parsers.goa_utils import filter_evidence, clean_annotations, propagate_terms, get_all_taxonomies
-
-
-def download_file(source_path, save_path):
-    if not os.path.exists(save_path):
-        urllib.request.urlretrieve(source_path, filename=os.path.join(save_path))
-    
-    out_file = save_path.split('.gz')[0]
-    if not os.path.exists(out_file):
-        with gzip.open(save_path, 'rb') as f_in:
-            with open(out_file, 'wb') as f_out:
-                shutil.copyfileobj(f_in, f_out)
-    return out_file
-
+from parsers.goa_utils import CHUNK_SIZE, parse_profiles, export_json
+from parsers.obo_utils import load_ontology
+from parsers.stage_cache import download_file, publish
+from parsers.partition_utils import parse_memory, filter_chunk_size
+from parsers.pipeline_utils import LABEL_OUTPUTS, filter_stage, profiles_filter_stage, label_stages, snapshot_stage
+from parsers.delta_utils import save_release, load_release
+from parsers.run_report import start_report, finish_report, report_stage
 
 
 if __name__ == '__main__':
@@ -28,11 +19,38 @@ if __name__ == '__main__':
     parser.add_argument('--dest', '-d', default=None,
                         help='Path to save processed files. Will be created if does not exist.')
     parser.add_argument('--gaf', '-g',
-                        help='Path to GAF file with annotations.')
+                        help='Path to GAF file with annotations. Can be gzipped (.gaf.gz).')
     parser.add_argument('--obo', '-o', default=None,
                         help='Path to OBO graph file if local. If empty (default) current OBO structure at run-time will be downloaded from http://purl.obolibrary.org/obo/go/go-basic.obo')
     parser.add_argument('--high', action='store_true',
                         help='Flag to include high-throughput evidence codes')    
+    parser.add_argument('--profiles', nargs='+', default=None,
+                        help='Evidence profiles to filter annotations with in a single read of the GAF file, eg. exp exp_high exp_iea=exp,inferred,IEA,!InterPro. '
+                             'Each profile is a predefined name (exp, exp_high) or name=items, where items are evidence codes, groups of codes (exp, inferred, high) '
+                             'or sources (Assigned_By) to exclude prefixed with !. The outputs of each profile are saved to <dest>/<name>/. Overrides --high')
+    parser.add_argument('--taxa', nargs='+', type=int, default=None,
+                        help='NCBI taxon IDs of the species to keep, eg. 9606 10090. Other annotations are dropped while the GAF file is read')
+    parser.add_argument('--proteins-file', default=None,
+                        help='Text file with the UniProt accessions of the proteins to keep, one per line. Other annotations are dropped while the GAF file is read')
+    parser.add_argument('--workers', '-w', type=int, default=1,
+                        help='Number of processes used to filter the GAF file (default 1)')
+    parser.add_argument('--json', action='store_true',
+                        help='Flag to also export the filtered annotations as JSON lines (<gaf>_evidence.json)')
+    parser.add_argument('--labels', choices=['tsv', 'matrix', 'both'], default='tsv',
+                        help='Save propagated labels as terms.tsv (default), as sparse label matrices per aspect in labels/, or both')
+    parser.add_argument('--cache-dir', default=None,
+                        help='Directory of cached intermediate results (default <dest>/cache). Each step is only recomputed when its inputs or parameters change')
+    parser.add_argument('--max-memory', default=None,
+                        help='Approximate memory budget, eg. 16G. Annotations are partitioned on disk by protein and processed one partition at a time')
+    parser.add_argument('--previous', default=None,
+                        help='Destination directory of the previous release processed with process_goa.py (with its cache). Only proteins whose annotations changed are propagated again, and the label changes are saved to changelog.tsv')
+    parser.add_argument('--cutoffs', nargs='+', default=None,
+                        help='Cutoff dates (YYYYMMDD or YYYY-MM-DD). Labels of the annotations made up to each date are saved to snapshots/<date>/, '
+                             'and the proteins newly annotated between consecutive dates to snapshots/targets_<date>_<next date>.tsv')
+    parser.add_argument('--report', default=None,
+                        help='JSON file to save a report of the run to: time, CPU, rows, bytes read and peak memory of each stage, and cache hits (default <dest>/run_report.json)')
+    parser.add_argument('--profile', default=None, metavar='STAGE',
+                        help='Name of a stage to profile with cProfile, eg. filter, clean or propagate. The profile is saved to profile_<stage>.prof next to the report')
     args = parser.parse_args() 
     
     # get raw annotations
@@ -49,6 +67,10 @@ if __name__ == '__main__':
     # create destination file if it doesn't exist
     if not os.path.isdir(data_location):
         os.makedirs(data_location)
+
+    # time, memory and cache hits of each stage are saved when the script exits
+    start_report(args.report if args.report is not None else os.path.join(data_location, 'run_report.json'),
+                 profile_stage=args.profile)
  
     # get ontology structure
     if args.obo is not None:
@@ -58,41 +80,87 @@ if __name__ == '__main__':
         obo_file = download_file('http://purl.obolibrary.org/obo/go/go-basic.obo', 
                                   os.path.join(data_location, 'go-basic.obo'))
     
-    # high-throughput evidence codes
-    include_highthr = args.high
-    print(f'Include high-throughput evidence codes? {include_highthr}')
+    # Each step is cached in cache_dir under a key of its inputs and parameters, and is only
+    # recomputed when one of them changes
+    cache_dir = args.cache_dir if args.cache_dir is not None else os.path.join(data_location, 'cache')
+    max_memory = parse_memory(args.max_memory) if args.max_memory is not None else None
+    assert args.previous is None or max_memory is None, '--previous can not be used with --max-memory'
+    assert args.cutoffs is None or (args.profiles is None and args.previous is None and max_memory is None), \
+        '--cutoffs can not be used with --profiles, --previous or --max-memory'
+    # blocks of GAF text parsed at once by each worker, smaller with a memory budget
+    chunk_size = filter_chunk_size(max_memory, args.workers) if max_memory is not None else CHUNK_SIZE
 
-    # output file to save
-    filtered_file=os.path.join(data_location, os.path.split(goa_file)[-1].split('.')[0]+'_evidence.json')
+    if args.profiles is not None:
+        profiles = parse_profiles(args.profiles)
+        for name in profiles:
+            assert os.path.abspath(os.path.join(data_location, name)) != os.path.abspath(cache_dir), \
+                f'Profile {name} would be saved to the cache directory {cache_dir}, use another name'
+        for name, profile in profiles.items():
+            print(f'Profile {name}: evidence codes {", ".join(profile.evidence)}'
+                  + (f', excluding sources {", ".join(profile.excluded_sources)}' if profile.excluded_sources else ''))
 
-    # save filtered evidence to file
-    if not os.path.exists(filtered_file):
-        print('Extracting annotations with experiment evidence codes')
-        print(f'Saving to {filtered_file}')
-        filtered_annotations = filter_evidence(goa_file, filtered_file, highthr=include_highthr)
-    else:
-        print(f'Filtered evidence GO annotation file exists. Loading annotations from file {filtered_file}')
-        filtered_annotations = pd.read_json(filtered_file, lines=True)
+        # save filtered evidence of all profiles to file in one pass
+        print('Extracting annotations of each evidence profile')
+        filtered_profiles = profiles_filter_stage(cache_dir, goa_file, profiles, workers=args.workers,
+                                                  taxa=args.taxa, proteins_file=args.proteins_file,
+                                                  chunk_size=chunk_size)
 
-    # Remove any duplicates or negative labels 
-    print('Removing duplicates and negative labels')
-    annotations_df = clean_annotations(filtered_annotations)
+        # the ontology is loaded once and used to propagate all profiles
+        ontology = load_ontology(obo_file, cache_dir=cache_dir)
+        for name, (filtered_file, filter_key) in filtered_profiles.items():
+            profile_location = os.path.join(data_location, name)
+            os.makedirs(profile_location, exist_ok=True)
+            print(f'Processing annotations of profile {name}: {filtered_file}')
+            if args.json:
+                json_file = os.path.join(profile_location, os.path.split(goa_file)[-1].split('.')[0]+'_evidence.json')
+                print(f'Exporting filtered annotations to {json_file}')
+                with report_stage('export_json'):
+                    export_json(filtered_file, json_file)
+            previous = load_release(os.path.join(args.previous, name)) if args.previous is not None else None
+            outputs_location, release = label_stages(cache_dir, filtered_file, filter_key, obo_file, labels=args.labels,
+                                                     max_memory=max_memory, ontology=ontology, previous=previous)
+            output_names = sorted(os.listdir(outputs_location))
+            print(f'Saving {", ".join(output_names)} to {profile_location}')
+            publish(outputs_location, output_names, profile_location, outputs=LABEL_OUTPUTS)
+            if release is not None:
+                save_release(release, profile_location)
+    else:
+        # high-throughput evidence codes
+        include_highthr = args.high
+        print(f'Include high-throughput evidence codes? {include_highthr}')
 
-    # Propagate labels to root and save to file
-    print('Propagating annotations to ontology roots and removing obsolete labels')
-    terms_df = propagate_terms(annotations_df, obo_file)
-    # In some cases, only obsolete terms are annotated for some protein
-    # so we get rid of any proteins without terms
-    annotations_df = annotations_df[annotations_df.DB_Object_ID.isin(terms_df.EntryID)]
+        # save filtered evidence to file
+        print('Extracting annotations with experiment evidence codes')
+        filtered_file, filter_key = filter_stage(cache_dir, goa_file, highthr=include_highthr, workers=args.workers,
+                                                 taxa=args.taxa, proteins_file=args.proteins_file,
+                                                 chunk_size=chunk_size)
+        print(f'Filtered annotations: {filtered_file}')
+        if args.json:
+            json_file = os.path.join(data_location, os.path.split(goa_file)[-1].split('.')[0]+'_evidence.json')
+            print(f'Exporting filtered annotations to {json_file}')
+            with report_stage('export_json'):
+                export_json(filtered_file, json_file)
 
-    # expand list of terms to that each one is in one row
-    all_terms = terms_df.explode('term').reset_index(drop=True)
-    terms_file = os.path.join(data_location, 'terms.tsv')
-    print(f'Saving terms to file {terms_file}')
-    all_terms.to_csv(terms_file, index=False, sep='\t')
+        # Remove duplicates and negative labels, propagate labels to root and find taxonomies
+        if args.cutoffs is not None:
+            # Labels as of each cutoff date and proteins newly annotated between cutoffs
+            snapshots_location = snapshot_stage(cache_dir, filtered_file, filter_key, obo_file, args.cutoffs,
+                                                labels=args.labels)
+            snapshots_dest = os.path.join(data_location, 'snapshots')
+            os.makedirs(snapshots_dest, exist_ok=True)
+            print(f'Saving snapshots to {snapshots_dest}')
+            # snapshots of other cutoffs are removed
+            publish(snapshots_location, sorted(os.listdir(snapshots_location)), snapshots_dest,
+                    outputs=os.listdir(snapshots_dest))
+        else:
+            # Only propagate again the proteins whose annotations changed since the previous release
+            previous = load_release(args.previous) if args.previous is not None else None
+            outputs_location, release = label_stages(cache_dir, filtered_file, filter_key, obo_file,
+                                                     labels=args.labels, max_memory=max_memory, previous=previous)
+            output_names = sorted(os.listdir(outputs_location))
+            print(f'Saving {", ".join(output_names)} to {data_location}')
+            publish(outputs_location, output_names, data_location, outputs=LABEL_OUTPUTS)
+            if release is not None:
+                save_release(release, data_location)
 
-    # Find taxonomies and save to file
-    taxdf = get_all_taxonomies(annotations_df)
-    taxonomy_file = os.path.join(data_location, 'taxonomy.tsv')
-    print(f'Saving terms to file {taxonomy_file}')
-    taxdf.to_csv(taxonomy_file, index=False, sep='\t')
+    finish_report()
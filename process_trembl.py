@@ -2,17 +2,27 @@ import os
 import sys
 import time
 from Bio import SeqIO
+from parsers.fasta_index import build_fasta_index
 
 if __name__ == '__main__':
     """
     Create SQL db for fast access to TrEMBL sequence data.
     Specify data location in first input argument 
+    Add --native as third argument to create a numpy index (uniprot_trembl.fidx) instead, using all CPUs
     """
 
     data_location = sys.argv[1]
     save_location = sys.argv[2]
     save_file = os.path.join(save_location, 'uniprot_trembl.idx')
     source_file = os.path.join(data_location, 'uniprot_trembl.fasta')
+
+    if '--native' in sys.argv[3:]:
+        save_file = os.path.join(save_location, 'uniprot_trembl.fidx')
+        print("Creating index for fasta file {}. Will be saved to {}".format(source_file, save_file))
+        start_time = time.time()
+        build_fasta_index(source_file, save_file, workers=os.cpu_count())
+        print('Elapsed time: {}s'.format(time.time()-start_time))
+        sys.exit()
     
     print("Creating SQLite index file for fasta file {}. Will be saved to {}".format(source_file, save_file))
     start_time = time.time()
@@ -0,0 +1,127 @@
+import os
+import sys
+import json
+import time
+import argparse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+from parsers.obo_utils import read_ontology
+from parsers.label_utils import load_propagated
+from parsers.delta_utils import load_release
+from parsers.query_index import build_query_index, load_query_index, protein_terms, term_proteins, \
+    ancestor_terms, descendant_terms
+
+
+def read_items(items, items_file):
+    """ Query items given on the command line and/or in a file with one item per line """
+    items = list(items)
+    if items_file is not None:
+        with open(items_file) as f:
+            items += [line.strip() for line in f if line.strip()]
+    return items
+
+
+def run_query(index, query, items, aspect=None, leaves=False, how='any'):
+    """
+    Answer a query with the index.
+
+    :param query: 'terms' (terms of each protein), 'proteins' (proteins with the terms), 'ancestors' or 'descendants'
+    :param items: accessions for 'terms', GO terms otherwise
+    :return: JSON serializable result
+    """
+    if query == 'terms':
+        return protein_terms(index, items, aspect=aspect, leaves=leaves)
+    if query == 'proteins':
+        return term_proteins(index, items, aspect=aspect, how=how).tolist()
+    if query == 'ancestors':
+        return ancestor_terms(index, items).tolist()
+    if query == 'descendants':
+        return descendant_terms(index, items).tolist()
+    raise ValueError(f'Unknown query {query}')
+
+
+def make_handler(index):
+    """ Request handler of the HTTP server, answering GET /<query>?items=a,b&aspect=BPO&leaves=1&how=all
+        with the JSON result of run_query """
+
+    class QueryHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urlparse(self.path)
+            params = parse_qs(url.query)
+            items = [item for value in params.get('items', []) for item in value.split(',') if item]
+            try:
+                result = run_query(index, url.path.strip('/'), items, aspect=params.get('aspect', [None])[0],
+                                   leaves=params.get('leaves', ['0'])[0] in ['1', 'true'],
+                                   how=params.get('how', ['any'])[0])
+                status, body = 200, result
+            except (ValueError, AssertionError) as error:
+                status, body = 400, {'error': str(error)}
+            content = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+    return QueryHandler
+
+
+if __name__ == '__main__':
+    """
+    Build a query index of the propagated labels of a dataset processed with process_goa.py, and look up the terms
+    of proteins or the proteins of terms from the command line or from a local HTTP server
+    """
+
+    parser = argparse.ArgumentParser(description='Query propagated Gene Ontology labels of proteins and terms')
+    parser.add_argument('query', choices=['build', 'terms', 'proteins', 'ancestors', 'descendants', 'serve'],
+                        help='build: index the labels of --release. terms: propagated terms of the proteins given. '
+                             'proteins: proteins labeled with the terms given. ancestors/descendants: of the terms given. '
+                             'serve: answer the same queries over HTTP, eg. GET /terms?items=P12345,Q9Y6K9&aspect=BPO')
+    parser.add_argument('items', nargs='*',
+                        help='Protein accessions (terms query) or GO terms (other queries)')
+    parser.add_argument('--index', '-i', default=None,
+                        help='Directory of the index (default <release>/index)')
+    parser.add_argument('--release', '-r', default=None,
+                        help='Destination directory of process_goa.py, with the release.json of the labels to index')
+    parser.add_argument('--items-file', default=None,
+                        help='Text file with more items to query, one per line')
+    parser.add_argument('--aspect', choices=['BPO', 'CCO', 'MFO'], default=None,
+                        help='Only return terms, or count labels, of one aspect')
+    parser.add_argument('--leaves', action='store_true',
+                        help='Flag to only return the most specific terms of each protein (terms query)')
+    parser.add_argument('--all', action='store_true',
+                        help='Flag to return the proteins labeled with all of the terms instead of any of them (proteins query)')
+    parser.add_argument('--host', default='127.0.0.1',
+                        help='Address to serve on (default 127.0.0.1, only local connections)')
+    parser.add_argument('--port', '-p', type=int, default=8000,
+                        help='Port to serve on (default 8000)')
+    args = parser.parse_args()
+
+    assert args.index is not None or args.release is not None, 'Give the index directory with --index or the dataset with --release'
+    index_location = args.index if args.index is not None else os.path.join(args.release, 'index')
+
+    if args.query == 'build':
+        assert args.release is not None, 'Give the dataset to index with --release'
+        release = load_release(args.release)
+        print(f'Indexing propagated labels from {release["propagated"]}')
+        rows, terms, propagated = load_propagated(release['propagated'])
+        build_query_index(rows, terms, propagated, read_ontology(release['ontology']), index_location)
+        sys.exit()
+
+    start_time = time.time()
+    index = load_query_index(index_location)
+    print(f'Loaded index {index_location} in {(time.time() - start_time) * 1000:.1f} ms', file=sys.stderr)
+
+    if args.query == 'serve':
+        server = ThreadingHTTPServer((args.host, args.port), make_handler(index))
+        print(f'Serving queries on http://{args.host}:{args.port}/ (terms, proteins, ancestors, descendants)',
+              file=sys.stderr)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            server.server_close()
+    else:
+        items = read_items(args.items, args.items_file)
+        result = run_query(index, args.query, items, aspect=args.aspect, leaves=args.leaves,
+                           how='all' if args.all else 'any')
+        print(json.dumps(result, indent=1))